@@ -26,7 +26,7 @@ def _create_kspace_sampling_density(nufft):
         """
         Compute k-space sampling density
         """    
-        y = numpy.ones(nufft.st['M'],dtype = numpy.complex64)
+        y = numpy.ones(nufft.multi_M,dtype = numpy.complex64)
 #         w = numpy.abs(nufft.xx2k(nufft.adjoint(y)))
         
         if nufft.parallel_flag == 1:
@@ -43,6 +43,9 @@ def L1TVOLS(nufft, y, maxiter, rho ): # main function of solver
     """
     L1-total variation regularized ordinary least square 
     """
+    if nufft.parallel_flag == 1:
+        # the TV split variables and uker are single images of Nd
+        raise ValueError('L1TVOLS does not support the batch mode')
     mu = 1.0
     LMBD = rho*mu
 
@@ -51,14 +54,14 @@ def L1TVOLS(nufft, y, maxiter, rho ): # main function of solver
         return x2
     def AH(y):
         
-        x2 = nufft.adjoint(y.reshape(nufft.st['M'], order='C'))
+        x2 = nufft.adjoint(y.reshape(nufft.multi_M, order='C'))
         return x2
     
         
     
     uker = mu*_create_kspace_sampling_density(nufft)
 #     print('uker.shape', uker.shape) 
-    uker = uker - LMBD* helper.create_laplacian_kernel(nufft)
+    uker = uker - LMBD* helper.create_laplacian_kernel(nufft, nufft.fftn)
 #     print('uker.shape', uker.shape)
 #     import matplotlib.pyplot
 #     matplotlib.pyplot.imshow(abs(uker))
@@ -170,14 +173,16 @@ def _pipe_density(nufft, maxiter):
 #         W = pipe_density(self.st['p'])
     # sampling density function
               
-    W = numpy.ones(nufft.st['M'],dtype=nufft.dtype)
+    W = numpy.ones(nufft.multi_M,dtype=nufft.dtype)
 #         V1= self.st['p'].getH()
     #     VVH = V.dot(V.getH()) 
          
     for pp in range(0,maxiter):
 #             E = self.st['p'].dot(V1.dot(W))
 
-        E = nufft.forward(nufft.adjoint(W))
+        # forward() and adjoint() in the layout of the plan (see hybrid)
+        x = nufft.xx2x(nufft.k2xx(nufft.y2k(W)))
+        E = nufft.k2y(nufft.xx2k(nufft.x2xx(x)))
         W = (W/E)
    
     return W
@@ -220,7 +225,8 @@ def solve(nufft,   y,  solver=None, *args, **kwargs):
     
             W = _pipe_density( nufft, *args, **kwargs)
     
-            x = nufft.adjoint(W*y)
+            # adjoint() in the layout of the plan (see hybrid)
+            x = nufft.xx2x(nufft.k2xx(nufft.y2k(W*y)))
     
             return x
         elif ('lsmr'==solver) or ('lsqr'==solver):
@@ -231,10 +237,10 @@ def solve(nufft,   y,  solver=None, *args, **kwargs):
             """
 #                 A = nufft.sp
             def sp(k):
-                k2 = k.reshape(nufft.Kd, order='C')
+                k2 = k.reshape(nufft.multi_Kd, order='C')
                 return nufft.k2y(k2).ravel()
             def spH(y):
-                y2 = y.reshape(nufft.st['M'], order='C')
+                y2 = y.reshape(nufft.multi_M, order='C')
                 return nufft.y2k(y2).ravel()                
 #                 return nufft.spH.dot(nufft.sp.dot(x))
 #                 print('shape', (nufft.st['M']*nufft.batch, nufft.Kdprod*nufft.batch))
@@ -245,9 +251,9 @@ def solve(nufft,   y,  solver=None, *args, **kwargs):
                                 'lsmr':scipy.sparse.linalg.lsmr,}
             k2 = methods[solver](A,  y.flatten(), *args, **kwargs)#,show=True)
             vec = k2[0]
-            vec.shape = nufft.Kd
+            vec.shape = nufft.multi_Kd
             xx = nufft.k2xx(vec)
-            x= xx/nufft.sn
+            x= nufft.tensor_sn.multiply(xx, dtype=nufft.dtype, inverse=True)
             return x#, k2[1:]        
         elif 'L1TVOLS' == solver:
             return  L1TVOLS(nufft, y, *args, **kwargs)
@@ -264,7 +270,7 @@ def solve(nufft,   y,  solver=None, *args, **kwargs):
             """
 #             A = nufft.spHsp#nufft.st['p'].getH().dot(nufft.st['p'])
             def spHsp(x):
-                k = x.reshape(nufft.Kd, order='C')
+                k = x.reshape(nufft.multi_Kd, order='C')
                 return nufft.k2y2k(k).ravel()
 #                 return nufft.spH.dot(nufft.sp.dot(x))
             
@@ -283,6 +289,6 @@ def solve(nufft,   y,  solver=None, *args, **kwargs):
             k2 = methods[solver](A,  nufft.y2k(y).ravel(), *args, **kwargs)#,show=True)
     
     
-            xx = nufft.k2xx(k2[0].reshape(nufft.Kd))
-            x= xx/nufft.sn
+            xx = nufft.k2xx(k2[0].reshape(nufft.multi_Kd))
+            x= nufft.tensor_sn.multiply(xx, dtype=nufft.dtype, inverse=True)
             return x#     , k2[1:]       
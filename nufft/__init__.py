@@ -39,14 +39,28 @@ class NUFFT:
     from ._nufft_class_methods_cpu import (
         _init__cpu,
         _plan_cpu,
+        _set_batch_cpu,
+        _allocate_cpu,
+        _save_plan_cpu,
+        _load_plan_cpu,
+        _update_plan_cpu,
+        _wait_plan_cpu,
+        _set_hybrid_cpu,
+        _x2hybrid_cpu,
+        _hybrid2x_cpu,
+        _hybrid2y_cpu,
         _precompute_sp_cpu,
+        _precompute_toeplitz_cpu,
+        _precompute_gram_cpu,
         _solve_cpu,
         _forward_cpu,
         _adjoint_cpu,
         _selfadjoint_cpu,
         _selfadjoint2_cpu,
+        _selfadjoint_toeplitz_cpu,
         _x2xx_cpu,
         _xx2k_cpu,
+        _xx2k_pruned_cpu,
         _xx2k_one2one_cpu,
         _k2vec_cpu,
         _vec2y_cpu,
@@ -55,6 +69,12 @@ class NUFFT:
         _vec2k_cpu,
         _y2k_cpu,
         _k2xx_cpu,
+        _k2xx_pruned_cpu,
+        _ifft_pruned_cpu,
+        _xx2k_real_cpu,
+        _ifft_real_cpu,
+        _x2k_cpu,
+        _k2x_cpu,
         _k2xx_one2one_cpu,
         _xx2x_cpu,
         _k2y2k_cpu,
@@ -169,13 +189,83 @@ class NUFFT:
                             Jd = (6,6,6) for a 3D image
         :param ft_axes: (Optional) The axes for Fourier transform.
                         The default is all axes if 'None' is given.
+        :param batch: (Optional, CPU only) The number of identical NUFFTs
+                      (e.g. coils) to be transformed together.
+                      x has the shape Nd + (batch, ) and y has (M, batch).
+        :param fft_backend: (Optional, CPU only) 'numpy' (default),
+                            'scipy' or 'pyfftw'.
+        :param threads: (Optional, CPU only) The number of CPU threads of
+                        the FFT, the interpolation and the planner.
+                        A negative number uses all the CPU cores.
+        :param preserve_dtype: (Optional, CPU only) Keep the whole CPU
+                               pipeline in numpy.complex64.
+        :param toeplitz: (Optional, CPU only) Compute selfadjoint()
+                         by the precomputed Toeplitz kernel.
+        :param gram: (Optional, CPU only) Cache spH.dot(sp) for k2y2k().
+                     True, False (default) or 'auto'.
+        :param gridding: (Optional, CPU only) The multi-threaded gridding:
+                         'partial' (private grids), 'tiles' (k-space tiles)
+                         or 'auto' (default).
+        :param reorder: (Optional, CPU only) Build the interpolator in the
+                        'morton' or 'tile' order of the samples.
+                        y stays in the order of om. Default: None.
+        :param format: (Optional, CPU only) 'CSR' (default), 'pELL',
+                       which stores only the 1D interpolators and forms
+                       their Kronecker product on the fly, or 'OTF',
+                       which recomputes the interpolator on the fly.
+        :param store_spH: (Optional, CPU and hsa_legacy) If False, only the
+                          forward interpolator is stored, and the adjoint
+                          is its transposed product. Default: True.
+        :param max_memory: (Optional, CPU only) The approximate bytes of the
+                           temporary arrays of the CSR planning.
+        :param cache: (Optional, CPU only) A helper.Plan_cache of the
+                      interpolators, keyed by a hash of om and the geometry.
+        :param background: (Optional, CPU only) Build the plan in a worker
+                           thread and return a helper.Plan_handle with
+                           ready() and wait(). forward(), adjoint(),
+                           selfadjoint() and solve() wait for the plan.
+        :param kernel: (Optional, CPU only) 'minmax' (default) or 'table',
+                       the tabulated min-max weights for faster planning.
+        :param pruned_fft: (Optional, CPU only) Skip the zero-padded lines
+                           in the oversampled FFT (default: True).
+        :param real: (Optional, CPU only) Real images: forward() takes a
+                     real image and adjoint() returns a real image, with
+                     rfftn over the Hermitian half spectrum. Requires
+                     format='CSR'. Default: False.
+        :param hybrid: (Optional, CPU only) Partial ft_axes (e.g.
+                       stack-of-stars): the lines of the other axes share
+                       the samples of om over ft_axes, and are transformed
+                       as a batch by one 2D (or 1D) interpolator and batched
+                       FFTs. y has the shape (M, ) + the other axes.
+                       Default: False.
+        :param tensor_sn: (Optional, CPU only) Share the scaling factors
+                          (tensor_sn) of another plan of the same Nd, Kd
+                          and Jd, or raise ValueError. Default: None.
         :type om: numpy.float array, matrix size = M * ndims
         :type Nd: tuple, ndims integer elements.
         :type Kd: tuple, ndims integer elements.
         :type Jd: tuple, ndims integer elements.
         :type ft_axes: None, or tuple with optional integer elements.
-        :returns: 0
-        :rtype: int, float
+        :type batch: None, or int
+        :type fft_backend: string
+        :type threads: None, or int
+        :type preserve_dtype: bool
+        :type toeplitz: bool
+        :type gram: bool or 'auto'
+        :type gridding: string
+        :type reorder: None or string
+        :type format: string
+        :type store_spH: bool
+        :type max_memory: None or int
+        :type cache: None or helper.Plan_cache
+        :type background: bool
+        :type kernel: string
+        :type pruned_fft: bool
+        :type real: bool
+        :type hybrid: bool
+        :type tensor_sn: None or helper.Tensor_sn
+        :returns: 0, or the helper.Plan_handle if background is True
+        :rtype: int, or helper.Plan_handle
 
         :ivar Nd: initial value: Nd
         :ivar Kd: initial value: Kd
@@ -192,6 +282,14 @@ class NUFFT:
 
         >>> NufftObj.plan(om, Nd, Kd, Jd, ft_axes)
 
+        or
+
+        >>> NufftObj.plan(om, Nd, Kd, Jd, batch=32)
+
+        or
+
+        >>> NufftObj.plan(om, Nd, Kd, Jd, fft_backend='scipy', threads=8)
+
         """
         func = {
             "cpu": self._plan_cpu,
@@ -200,13 +298,61 @@ class NUFFT:
         }
         return func.get(self.processor)(*args, **kwargs)
 
+    def save_plan(self, *args, **kwargs):
+        """
+        Save the plan to a directory of raw .npy files (CPU only).
+        >>> NufftObj.plan(om, Nd, Kd, Jd)
+        >>> NufftObj.save_plan('plan_dir')
+
+        :param path: The directory of the plan
+        :type path: string
+        """
+        func = {"cpu": self._save_plan_cpu}
+        return func.get(self.processor)(*args, **kwargs)
+
+    def load_plan(self, *args, **kwargs):
+        """
+        Load the plan saved by save_plan() (CPU only).
+        The arrays are memory-mapped, instead of planning again.
+        >>> NufftObj = NUFFT()
+        >>> NufftObj.load_plan('plan_dir')
+
+        :param path: The directory of the plan
+        :param mmap_mode: (Optional) The mmap_mode of numpy.load(),
+                          default: 'r'
+        :type path: string
+        :type mmap_mode: string or None
+        """
+        func = {"cpu": self._load_plan_cpu}
+        return func.get(self.processor)(*args, **kwargs)
+
+    def update_plan(self, *args, **kwargs):
+        """
+        Update the plan after samples are appended or removed (CPU only).
+        Only the interpolator rows of the new samples are computed.
+        >>> NufftObj.update_plan(add_om=new_spokes, remove_rows=range(0, 512))
+
+        :param add_om: (Optional) The new samples, appended at the end of y
+        :param remove_rows: (Optional) The indices of the removed samples
+        :param max_memory: (Optional) The approximate bytes of the
+                           temporary arrays of the new rows
+        :type add_om: None or numpy.float array, matrix size = M_add * ndims
+        :type remove_rows: None, int array or bool array
+        :type max_memory: None or int
+        """
+        func = {"cpu": self._update_plan_cpu}
+        return func.get(self.processor)(*args, **kwargs)
+
     def forward(self, *args, **kwargs):
         """
         Forward NUFFT (host code)
 
         :param x: The input numpy array, with the size of Nd
+                  (or Nd + (batch, ) in batch mode)
+        :param out: (Optional, CPU only) The preallocated output array y
         :type: numpy array with the dtype of numpy.complex64
         :return: y: The output numpy array, with the size of (M,)
+                    (or (M, batch) in batch mode)
         :rtype: numpy array with the dtype of numpy.complex64
         """
         func = {
@@ -221,9 +367,11 @@ class NUFFT:
         Adjoint NUFFT (host code)
 
         :param y: The input numpy array, with the size of (M,)
+                  (or (M, batch) in batch mode)
+        :param out: (Optional, CPU only) The preallocated output array x
         :type: numpy array with the dtype of numpy.complex64
         :return: x: The output numpy array,
-                    with the size of Nd or Nd
+                    with the size of Nd or Nd + (batch, )
         :rtype: numpy array with the dtype of numpy.complex64
         """
         func = {
@@ -238,6 +386,7 @@ class NUFFT:
         selfadjoint NUFFT (host code)
 
         :param x: The input numpy array, with size=Nd
+        :param out: (Optional, CPU only) The preallocated output array
         :type: numpy array with dtype =numpy.complex64
         :return: x: The output numpy array, with size=Nd
         :rtype: numpy array with dtype =numpy.complex64
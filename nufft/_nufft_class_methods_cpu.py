@@ -1,6 +1,29 @@
+import os
+import json
 import numpy
+import scipy.sparse
+import functools
+import threading
+import concurrent.futures
 from ..src._helper import helper  # , helper1
 
+PLAN_VERSION = 1  # : the version of the files of save_plan()
+
+
+def _locked(method):
+    """
+    Private: run the method under the lock of the plan.
+    The workspaces of the plan (x_Nd, k_Kd, y_M and the private grids of
+    the interpolator) are shared by the calls, so the calls of the threads
+    which share a NUFFT object are serialized. The lock is reentrant,
+    as forward() calls k2y() and solve() calls forward().
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 def _init__cpu(self):
     """
@@ -23,9 +46,27 @@ def _init__cpu(self):
     self.ndims = 0  # : initial value: 0
     self.ft_axes = ()  # : initial value: ()
     self.batch = None  # : initial value: None
-
-
-def _plan_cpu(self, om, Nd, Kd, Jd, ft_axes=None):
+    self.threads = 1  # : initial value: 1
+    self.pool = None  # : initial value: None
+    self.plan_handle = None  # : initial value: None
+    self.lock = threading.RLock()  # : the lock of the workspaces
+    self.kernel = 'minmax'  # : initial value: 'minmax'
+    self.pruned_fft = True  # : initial value: True
+    self.real = False  # : initial value: False
+    self.hybrid = False  # : initial value: False
+    self.fft_backend = 'numpy'  # : initial value: 'numpy'
+    self.preserve_dtype = False  # : initial value: False
+    self.toeplitz = False  # : initial value: False
+    self.gram = False  # : initial value: False
+    self.fftn, self.ifftn = helper.fft_backend(self.fft_backend)
+
+
+def _plan_cpu(self, om, Nd, Kd, Jd, ft_axes=None, batch=None,
+              fft_backend='numpy', threads=None, preserve_dtype=False,
+              toeplitz=False, gram=False, gridding='auto', reorder=None,
+              format='CSR', store_spH=True, max_memory=None,
+              cache=None, background=False, kernel='minmax',
+              pruned_fft=True, real=False, hybrid=False, tensor_sn=None):
     """
     Plan the NUFFT_cpu object with the geometry provided.
 
@@ -45,14 +86,133 @@ def _plan_cpu(self, om, Nd, Kd, Jd, ft_axes=None):
     :param batch: (Optional) Batch mode.
                  If the batch is provided, the last appended axis is the number
                  of identical NUFFT to be transformed.
+                 x has the shape Nd + (batch, ) and y has the shape (M, batch).
                  The default is 'None'.
+    :param fft_backend: (Optional) The FFT of the CPU.
+                 'numpy' (default), 'scipy' (scipy.fft) or 'pyfftw'.
+    :param threads: (Optional) The number of CPU threads of the FFT,
+                 of the interpolation and of helper.plan().
+                 The default is 'None' (1 thread).
+                 A negative number uses all the CPU cores.
+    :param preserve_dtype: (Optional) Keep the interpolator, the scaling
+                 factor and all the intermediate arrays in self.dtype
+                 (numpy.complex64), instead of the double precision
+                 interpolator. The default is False.
+    :param toeplitz: (Optional) Precompute the Toeplitz kernel, so that
+                 selfadjoint() is computed by two FFTs of size 2*Nd,
+                 without interpolation. Requires all axes in ft_axes.
+                 The default is False.
+    :param gram: (Optional) Cache the Gram matrix spH.dot(sp), so that
+                 k2y2k() (the 'cg', 'bicgstab', ... solvers) costs one
+                 sparse matrix-vector multiplication instead of two.
+                 The matrix is computed at the first call of k2y2k().
+                 True: always; 'auto': only if its estimated number of
+                 non-zeros is smaller than those of sp and spH;
+                 False: never (default).
+    :param gridding: (Optional) The strategy of the multi-threaded gridding
+                 (y2k) if threads > 1.
+                 'partial': every thread scatters a block of samples into
+                 its private Kd grid, and the grids are summed;
+                 'tiles': every thread gathers a non-overlapping tile of
+                 k-space from the rows of spH, so threads never collide;
+                 'auto' (default): 'partial' if the threads * prod(Kd)
+                 private grids are smaller than the interpolator,
+                 otherwise 'tiles'.
+    :param reorder: (Optional) Build the interpolator in a locality-aware
+                 order of the samples: 'morton' (Z-order curve) or 'tile'
+                 (k-space tiles), which improves the cache hits of the
+                 interpolation and the gridding. y remains in the order of
+                 om, as forward() and adjoint() permute it.
+                 The default is None (the order of om).
+    :param format: (Optional) The storage of the interpolator.
+                 'CSR' (default): the precomputed M * prod(Jd) sparse matrix;
+                 'pELL': only the M * sum(Jd) 1D factors (in complex64) are
+                 stored, and the Kronecker weights are formed on the fly for
+                 chunks of samples;
+                 'OTF': matrix-free, only om and the min-max parameters
+                 (alpha, beta and nufft_T) are stored, and the interpolator
+                 of every chunk is recomputed in k2y() and y2k().
+                 gram is not available with 'pELL' and 'OTF'.
+    :param store_spH: (Optional) Store the adjoint interpolator spH.
+                 If False, only sp is stored, and y2k() is the transposed
+                 product of sp, which halves the memory and the time of
+                 the CSR plan. The 'tiles' gridding requires spH.
+                 The default is True.
+    :param max_memory: (Optional) The approximate bytes of the temporary
+                 arrays of helper.plan(), which builds the CSR interpolator
+                 in chunks of samples. The default is None (64 MiB).
+    :param cache: (Optional) A helper.Plan_cache, which returns the
+                 interpolator (and spH) of a previous plan of the same om
+                 and geometry instead of building it again.
+                 The default is None.
+    :param background: (Optional) Build the plan in a worker thread.
+                 plan() returns a helper.Plan_handle at once, and
+                 forward(), adjoint(), selfadjoint() and solve() wait for
+                 the plan if they are called before it is ready.
+                 The default is False.
+    :param kernel: (Optional) The 1D interpolator.
+                 'minmax' (default): the exact min-max weights;
+                 'table': the linear interpolation of the min-max weights,
+                 tabulated once per (N, J, K), which speeds up the planning
+                 (and the 'OTF' format). The weights are within 6e-8 of the
+                 exact weights, see helper.table_interp().
+    :param pruned_fft: (Optional) The oversampled FFT is computed axis by
+                 axis, and every 1D FFT runs only over the lines of the
+                 image which are not zero (xx2k) or which are kept (k2xx),
+                 with the zero-padding and the cropping folded in.
+                 False: zero-pad to Kd and compute the full fftn.
+                 The default is True.
+    :param real: (Optional) The real image mode. forward() takes a real
+                 image and adjoint() and selfadjoint() return the real part
+                 of the image. The spectrum of a real image is Hermitian,
+                 so only its half (the last axis of ft_axes cropped to
+                 K // 2 + 1) is computed by rfftn, and the interpolator
+                 (helper.Hermitian_CSR) reads the other half from the
+                 mirrored columns. The FFT and the k-space arrays are
+                 halved, and spH is not stored. Requires format='CSR';
+                 solve(), gram, save_plan() and update_plan() are not
+                 available. The default is False.
+    :param hybrid: (Optional) The hybrid Cartesian/non-Cartesian mode of
+                 partial ft_axes (e.g. stack-of-stars). All the lines of
+                 the other axes share the M samples of om over ft_axes
+                 (the columns of the other axes are ignored), so only the
+                 interpolator of ft_axes is planned, and the other axes
+                 are transformed as the batch of the plan: one sparse
+                 matrix-dense matrix product and batched FFTs.
+                 x has the shape Nd (+ (batch, )) and y has the shape
+                 (M, ) + the other axes of Nd (+ (batch, )).
+                 Nd, Kd, Jd and ft_axes of the plan are those of ft_axes,
+                 and the k-space methods (xx2k, k2y, y2k, k2xx) take the
+                 arrays of the plan batch. The default is False.
+    :param tensor_sn: (Optional) The scaling factors (self.tensor_sn, a
+                 helper.Tensor_sn) of another plan of the same Nd, Kd and
+                 Jd, which are shared instead of being computed again.
+                 Another geometry raises ValueError. The default is None.
     :type om: numpy.float array, matrix size = M * ndims
     :type Nd: tuple, ndims integer elements.
     :type Kd: tuple, ndims integer elements.
     :type Jd: tuple, ndims integer elements.
     :type ft_axes: None, or tuple with optional integer elements.
-    :returns: 0
-    :rtype: int, float
+    :type batch: None, or int
+    :type fft_backend: string
+    :type threads: None, or int
+    :type preserve_dtype: bool
+    :type toeplitz: bool
+    :type gram: bool or 'auto'
+    :type gridding: string
+    :type reorder: None or string
+    :type format: string, 'CSR', 'pELL' or 'OTF'
+    :type store_spH: bool
+    :type max_memory: None or int
+    :type cache: None or helper.Plan_cache
+    :type background: bool
+    :type kernel: string, 'minmax' or 'table'
+    :type pruned_fft: bool
+    :type real: bool
+    :type hybrid: bool
+    :type tensor_sn: None or helper.Tensor_sn
+    :returns: 0, or the helper.Plan_handle if background is True
+    :rtype: int, or helper.Plan_handle
 
     :ivar Nd: initial value: Nd
     :ivar Kd: initial value: Kd
@@ -69,62 +229,301 @@ def _plan_cpu(self, om, Nd, Kd, Jd, ft_axes=None):
 
     >>> NufftObj.plan(om, Nd, Kd, Jd, ft_axes)
 
+    or, for 32 coils
+
+    >>> NufftObj.plan(om, Nd, Kd, Jd, batch=32)
+
     """
 
+    if background:
+        self.plan_handle = helper.Plan_handle(
+            self._plan_cpu, om, Nd, Kd, Jd, ft_axes=ft_axes, batch=batch,
+            fft_backend=fft_backend, threads=threads,
+            preserve_dtype=preserve_dtype, toeplitz=toeplitz, gram=gram,
+            gridding=gridding, reorder=reorder, format=format,
+            store_spH=store_spH, max_memory=max_memory, cache=cache,
+            kernel=kernel, pruned_fft=pruned_fft, real=real, hybrid=hybrid,
+            tensor_sn=tensor_sn)
+        return self.plan_handle
+
+    self.hybrid = hybrid
+    if self.hybrid:
+        # plan ft_axes, the other axes are transformed as the batch
+        if ft_axes is None:
+            ft_axes = range(0, len(Nd))
+        ft_axes = tuple(ft_axes)
+        om = numpy.asarray(om)
+        if om.shape[1] == len(Nd):
+            om = om[:, list(ft_axes)]
+        batch = self._set_hybrid_cpu(Nd, ft_axes, batch)
+        Nd = tuple(Nd[d] for d in ft_axes)
+        Kd = tuple(Kd[d] for d in ft_axes)
+        Jd = tuple(Jd[d] for d in ft_axes)
+        ft_axes = None
+
     self.ndims = len(Nd)  # : initial value: len(Nd)
     if ft_axes is None:
         ft_axes = range(0, self.ndims)
     self.ft_axes = ft_axes  # default: all axes (range(0, self.ndims)
 
-    self.st = helper.plan(om, Nd, Kd, Jd, ft_axes=ft_axes,
-                          format='CSR')
+    self.threads = helper.cpu_threads(threads)
+    self.fft_backend = fft_backend
+    self.fftn, self.ifftn = helper.fft_backend(fft_backend, self.threads)
+    self.pruned_fft = pruned_fft
+    self.preserve_dtype = preserve_dtype
+    self.real = real
+    if self.real:
+        self.rfftn, self.irfftn = helper.rfft_backend(fft_backend,
+                                                      self.threads)
+
+    if format not in ('CSR', 'pELL', 'OTF'):
+        raise ValueError("format must be 'CSR', 'pELL' or 'OTF'")
+    self.format = format
+    if self.real and self.format != 'CSR':
+        raise ValueError("real requires format='CSR'")
+    if (self.format != 'CSR' or self.real) and gram:
+        if gram is True:
+            raise ValueError("gram requires format='CSR' and real=False")
+        gram = False
+
+    self.kernel = kernel
+    self.reorder = reorder
+    if self.preserve_dtype:
+        csr_dtype = self.dtype  # the CSR is filled in self.dtype
+    else:
+        csr_dtype = numpy.complex128
+    adjoint = store_spH and not self.real  # spH is cached next to sp
+    if self.reorder is None:
+        self.st = helper.plan(om, Nd, Kd, Jd, ft_axes=ft_axes,
+                              format=format, radix=1, max_memory=max_memory,
+                              threads=self.threads, cache=cache,
+                              kernel=kernel, dtype=csr_dtype,
+                              adjoint=adjoint, tensor_sn=tensor_sn)
+    else:
+        om = numpy.asarray(om)
+        self.sample_order = helper.sample_order(
+            om[:, list(ft_axes)], tuple(Kd[d] for d in ft_axes),
+            order=reorder)
+        self.st = helper.plan(om[self.sample_order], Nd, Kd, Jd,
+                              ft_axes=ft_axes, format=format, radix=1,
+                              max_memory=max_memory, threads=self.threads,
+                              cache=cache, kernel=kernel, dtype=csr_dtype,
+                              adjoint=adjoint, tensor_sn=tensor_sn)
+        self.st['om'] = om  # the order of the caller
 
     self.Nd = self.st['Nd']  # backup
     self.Kd = self.st['Kd']
-    # backup
-    self.sn = numpy.asarray(self.st['sn'].astype(self.dtype), order='C')
-
-#     if batch is None:  # single-coil
-    self.parallel_flag = 0
-    self.batch = 1
-
-#     else:  # multi-coil
-#         self.parallel_flag = 1
-#         self.batch = batch
-
-#     if self.parallel_flag is 1:
-#         self.multi_Nd = self.Nd + (self.batch, )
-#         self.uni_Nd = self.Nd + (1, )
-#         self.multi_Kd = self.Kd + (self.batch, )
-#         self.multi_M = (self.st['M'], ) + (self.batch, )
-#         self.multi_prodKd = (numpy.prod(self.Kd), self.batch)
-#         self.sn = numpy.reshape(self.sn, self.Nd + (1,))
-
-#     elif self.parallel_flag is 0:
-    self.Nd = self.Nd  # + (self.Reps, )
-    self.Nd = self.Nd
-    self.Kd = self.Kd  # + (self.Reps, )
-    self.M = (self.st['M'], )
-    self.prodKd = (numpy.prod(self.Kd), )
+    # the separable scaling factor, applied without the dense sn
+    self.tensor_sn = self.st['tSN']
 
-    # Calculate the density compensation function
-    self.sp = self.st['p'].copy().tocsr()
+    self._set_batch_cpu(batch)
 
-    self.spH = (self.st['p'].getH().copy()).tocsr()
+    # Calculate the density compensation function
+    if self.format != 'CSR':
+        # the 1D factors (pELL) or the min-max parameters (OTF)
+        # replace sp and spH
+        if self.format == 'pELL':
+            self.interpolator = self.st['pELL']
+            del self.st['pELL']
+        else:
+            self.interpolator = self.st['otf']
+            del self.st['otf']
+        self.sp = None
+        self.spH = None
+        if self.preserve_dtype:
+            self.interp_dtype = numpy.dtype(self.dtype)
+        else:
+            self.interp_dtype = numpy.dtype(numpy.complex128)
+    else:
+        self.sp = self.st['p']  # in csr_dtype
+        if adjoint:
+            self.spH = self.st['pH']  # in csr_dtype
+            del self.st['pH']
+        else:
+            self.spH = None  # y2k() is the transposed product of sp
+        self.interp_dtype = self.sp.dtype
+        del self.st['p']
+        if self.real:
+            # the interpolator of the half spectrum replaces sp
+            self.interpolator = helper.Hermitian_CSR(
+                self.sp, self.Kd, self.ft_axes, nblocks=self.threads)
+            self.sp = None
 
     self.Kdprod = numpy.int32(numpy.prod(self.st['Kd']))
     self.Jdprod = numpy.int32(numpy.prod(self.st['Jd']))
-    del self.st['p'], self.st['sn']
 
-    self.NdCPUorder, self.KdCPUorder, self.nelem = helper.preindex_copy(
-        self.st['Nd'],
-        self.st['Kd'])
+    # the image is the corner Nd of the Kd grid
+    self.Nd_slice = tuple(slice(0, N) for N in self.Nd)
+
+    self._allocate_cpu(gridding)
 #     self.volume = {}
 #     self.volume['cpu_coil_profile'] = numpy.ones(self.multi_Nd)
 
+    self.toeplitz = toeplitz
+    if self.toeplitz:
+        self._precompute_toeplitz_cpu()
+
+    self.gram = gram
+    self.spHsp = None  # computed by _precompute_gram_cpu()
+
+    self.plan_handle = None  # the plan is ready
     return 0
 
 
+def _set_hybrid_cpu(self, Nd, ft_axes, batch):
+    """
+    Private: Set the shapes of the hybrid mode, see plan().
+
+    :param Nd: The image shape, including the axes without FFT
+    :param ft_axes: The axes of the FFT
+    :param batch: The batch of the caller, or None
+    :return: the batch of the plan: the lines of the other axes * batch
+    :rtype: int
+    """
+    self.hybrid = True
+    self.hybrid_Nd = tuple(Nd)
+    self.hybrid_ft_axes = tuple(ft_axes)
+    self.hybrid_batch = batch
+    other = tuple(Nd[d] for d in range(0, len(Nd)) if d not in ft_axes)
+    if batch is not None:
+        other += (batch, )
+    # the image with ft_axes first, and the shape of y
+    self.hybrid_shape = tuple(Nd[d] for d in ft_axes) + other
+    self.hybrid_M = other
+    return int(numpy.prod(other))
+
+
+def _x2hybrid_cpu(self, x):
+    """
+    Private: the image of the caller to the image of the hybrid plan,
+    with ft_axes first and the other axes in the batch.
+    A view if ft_axes are the leading axes.
+    """
+    x = numpy.moveaxis(x, self.hybrid_ft_axes,
+                       range(0, len(self.hybrid_ft_axes)))
+    return numpy.reshape(x, self.multi_Nd)
+
+
+def _hybrid2x_cpu(self, x, out=None):
+    """
+    Private: the reverse of _x2hybrid(), copied into out if given
+    """
+    x = numpy.reshape(x, self.hybrid_shape)
+    x = numpy.moveaxis(x, range(0, len(self.hybrid_ft_axes)),
+                       self.hybrid_ft_axes)
+    if out is not None:
+        out[...] = x
+        x = out
+    return x
+
+
+def _hybrid2y_cpu(self, y, out=None):
+    """
+    Private: y of the hybrid plan, (M, batch), to y of the caller,
+    (M, ) + the other axes (+ (batch, )), copied into out if given
+    """
+    y = numpy.reshape(y, (self.st['M'], ) + self.hybrid_M)
+    if out is not None:
+        out[...] = y
+        y = out
+    return y
+
+
+def _wait_plan_cpu(self):
+    """
+    Private: Wait for the plan built in the background, see plan().
+    """
+    plan_handle = self.plan_handle
+    if plan_handle is not None:
+        plan_handle.wait()
+
+
+def _set_batch_cpu(self, batch):
+    """
+    Private: Set the batch mode and the shapes of the arrays.
+
+    :param batch: The size of the batch, or None for a single array
+    :type batch: int or None
+    :return: self: instance
+    """
+    if batch is None:  # single-coil
+        self.parallel_flag = 0
+        self.batch = 1
+
+    else:  # multi-coil
+        self.parallel_flag = 1
+        self.batch = int(batch)
+
+    self.M = (self.st['M'], )
+    self.prodKd = (numpy.prod(self.Kd), )
+
+    if self.parallel_flag == 1:
+        self.multi_Nd = self.Nd + (self.batch, )
+        self.uni_Nd = self.Nd + (1, )
+        self.multi_Kd = self.Kd + (self.batch, )
+        self.multi_M = (self.st['M'], ) + (self.batch, )
+        self.multi_prodKd = (numpy.prod(self.Kd), self.batch)
+
+    else:
+        self.multi_Nd = self.Nd
+        self.uni_Nd = self.Nd
+        self.multi_Kd = self.Kd
+        self.multi_M = self.M
+        self.multi_prodKd = self.prodKd
+
+    # the shape of the k-space arrays, the half spectrum if self.real
+    if self.real:
+        axis = tuple(self.ft_axes)[-1]
+        Kh = self.Kd[:axis] + (self.Kd[axis] // 2 + 1, ) + self.Kd[axis + 1:]
+    else:
+        Kh = self.Kd
+    self.multi_Kh = Kh + self.multi_Kd[len(self.Kd):]
+
+
+def _allocate_cpu(self, gridding):
+    """
+    Private: Allocate the workspaces and the multi-threaded interpolators.
+
+    :param gridding: 'auto', 'partial' or 'tiles', see plan()
+    :type gridding: string
+    :return: self: instance
+    """
+    # workspaces of forward(), adjoint() and selfadjoint()
+    if self.real:
+        self.x_Nd = numpy.zeros(self.multi_Nd, order='C',
+                                dtype=numpy.finfo(self.dtype).dtype)
+    else:
+        self.x_Nd = numpy.zeros(self.multi_Nd, dtype=self.dtype, order='C')
+    self.k_Kd = numpy.zeros(self.multi_Kh, dtype=self.dtype, order='C')
+    self.y_M = numpy.zeros(self.multi_M, dtype=self.interp_dtype, order='C')
+
+    if self.threads > 1 and (self.format != 'CSR' or self.real):
+        # the interpolation is multi-threaded over the chunks of samples
+        # (or the row blocks of Hermitian_CSR)
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        gridding = None
+    elif self.threads > 1:
+        # row blocks of sp for the multi-threaded interpolation
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.sp_blocks = helper.CSR_blocks(self.sp, self.threads)
+        if gridding == 'auto':
+            if (self.threads * int(self.Kdprod) <= self.sp.nnz or
+                    self.spH is None):
+                gridding = 'partial'
+            else:
+                gridding = 'tiles'
+        if gridding == 'tiles':
+            if self.spH is None:
+                raise ValueError("gridding='tiles' requires store_spH=True")
+            # k-space tiles are the row blocks of spH
+            self.spH_blocks = helper.CSR_blocks(self.spH, self.threads)
+        elif gridding != 'partial':
+            raise ValueError("gridding must be 'auto', 'partial' or 'tiles'")
+    else:
+        self.pool = None
+    self.gridding = gridding
+
+
 def _precompute_sp_cpu(self):
     """
 
@@ -136,7 +535,7 @@ def _precompute_sp_cpu(self):
     :return: self: instance
     """
     try:
-        W0 = numpy.ones((self.st['M'],), dtype=numpy.complex64)
+        W0 = numpy.ones(self.multi_M, dtype=numpy.complex64)
         W = self.xx2k(self.adjoint(W0))
         self.W = (W*W.conj())**0.5
         del W0
@@ -146,6 +545,309 @@ def _precompute_sp_cpu(self):
         raise
 
 
+def _precompute_toeplitz_cpu(self):
+    """
+    Private: Precompute the Toeplitz kernel of the selfadjoint operator.
+
+    The Gram matrix A^H A is Toeplitz:
+    (A^H A)[n, n'] = h(n - n'), h(d) = sum_m exp(1j * om[m] . d) / prod(Kd),
+    for -Nd < d < Nd.
+    h is computed once by the adjoint NUFFT on the 2*Nd grid,
+    and embedded in a circulant matrix, which is diagonalized by the FFT.
+
+    :param None:
+    :type None: Python Nonetype
+    :return: self: instance
+    """
+    if len(tuple(self.ft_axes)) != self.ndims:
+        raise ValueError('toeplitz requires the FFT over all axes')
+    Nd2 = tuple(2 * N for N in self.Nd)
+    Kd2 = tuple(2 * K for K in self.Kd)
+    psf_nufft = self.__class__()
+    psf_nufft.plan(self.st['om'], Nd2, Kd2, self.st['Jd'],
+                   fft_backend=self.fft_backend, threads=self.threads,
+                   preserve_dtype=self.preserve_dtype, format=self.format,
+                   store_spH=False, kernel=self.kernel)
+    # psf[n2] = h(n2 - Nd), ifftshift() moves h(0) to the origin
+    psf = psf_nufft.adjoint(numpy.ones(self.M, dtype=self.dtype))
+    del psf_nufft
+    # adjoint() is normalized by 1/prod(Kd) of the ifftn
+    psf *= numpy.prod(Kd2) / numpy.prod(self.Kd)
+    kernel = self.fftn(numpy.fft.ifftshift(psf).astype(self.dtype),
+                       axes=range(0, self.ndims))
+    if self.parallel_flag == 1:
+        kernel = numpy.reshape(kernel, Nd2 + (1, ))
+    self.toeplitz_kernel = numpy.asarray(kernel, dtype=self.dtype, order='C')
+
+    # workspace of the zero-padded image
+    self.x_2Nd = numpy.zeros(self.toeplitz_kernel.shape[:self.ndims]
+                             + self.multi_Nd[self.ndims:],
+                             dtype=self.dtype, order='C')
+    self.Nd_slice = tuple(slice(0, N) for N in self.Nd)
+
+
+def _precompute_gram_cpu(self):
+    """
+    Private: Precompute the Gram matrix self.spHsp = spH.dot(sp)
+
+    If self.gram is 'auto', the matrix is built only if it pays off.
+    Each row of spHsp couples the grid points within (2*Jd - 1) of each
+    other, so its number of non-zeros is bounded by
+    min(prod(Kd), M*prod(Jd)) * prod(2*Jd - 1),
+    which is compared with the 2*M*prod(Jd) non-zeros of sp and spH.
+
+    :param None:
+    :type None: Python Nonetype
+    :return: self: instance
+    """
+    if self.gram == 'auto':
+        nnz = int(self.st['M']) * int(self.Jdprod)
+        gram_nnz = (min(int(self.Kdprod), nnz) *
+                    numpy.prod([2 * J - 1 for J in self.st['Jd']]))
+        if gram_nnz >= 2 * nnz:
+            self.gram = False  # do not check again
+            return
+    if self.spH is None:
+        self.spHsp = self.sp.getH().dot(self.sp).tocsr()
+    else:
+        self.spHsp = self.spH.dot(self.sp).tocsr()
+
+
+def _save_plan_cpu(self, path):
+    """
+    Save the plan to the directory path.
+
+    The interpolator (sp, spH), the 1D scaling factors snd and the index arrays
+    are stored as raw .npy files, which load_plan() maps into memory.
+    The geometry and the options of plan() are stored in plan.json,
+    together with the version of the file format.
+
+    :param path: The directory of the plan, created if it does not exist
+    :type path: string
+    :return: self: instance
+    """
+    self._wait_plan_cpu()
+    if self.format != 'CSR' or self.real:
+        raise ValueError("save_plan requires format='CSR' and real=False")
+    os.makedirs(path, exist_ok=True)
+    arrays = {'sp_data': self.sp.data,
+              'sp_indices': self.sp.indices,
+              'sp_indptr': self.sp.indptr,
+              'om': self.st['om']}
+    for dimid, factor in enumerate(self.tensor_sn.factors):
+        arrays['snd%d' % dimid] = numpy.reshape(factor, (-1, 1))
+    if self.spH is not None:
+        arrays.update({'spH_data': self.spH.data,
+                       'spH_indices': self.spH.indices,
+                       'spH_indptr': self.spH.indptr})
+    if self.reorder is not None:
+        arrays['sample_order'] = self.sample_order
+    if self.toeplitz:
+        arrays['toeplitz_kernel'] = numpy.reshape(
+            self.toeplitz_kernel, self.toeplitz_kernel.shape[:self.ndims])
+    for key in arrays:
+        numpy.save(os.path.join(path, key + '.npy'), arrays[key])
+
+    if self.gridding == 'tiles':
+        gridding = 'tiles'
+    else:
+        gridding = 'auto'
+    meta = {'version': PLAN_VERSION,
+            'Nd': [int(N) for N in self.Nd],
+            'Kd': [int(K) for K in self.Kd],
+            'Jd': [int(J) for J in self.st['Jd']],
+            'M': int(self.st['M']),
+            'ft_axes': [int(d) for d in self.ft_axes],
+            'batch': self.batch if self.parallel_flag == 1 else None,
+            'fft_backend': self.fft_backend,
+            'threads': self.threads,
+            'preserve_dtype': self.preserve_dtype,
+            'toeplitz': self.toeplitz,
+            'gram': self.gram,
+            'gridding': gridding,
+            'reorder': self.reorder,
+            'kernel': self.kernel,
+            'pruned_fft': self.pruned_fft,
+            'hybrid': None,
+            'arrays': sorted(arrays)}
+    if self.hybrid:
+        meta['hybrid'] = {'Nd': [int(N) for N in self.hybrid_Nd],
+                          'ft_axes': [int(d) for d in self.hybrid_ft_axes],
+                          'batch': self.hybrid_batch}
+    with open(os.path.join(path, 'plan.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def _load_plan_cpu(self, path, mmap_mode='r'):
+    """
+    Load the plan saved by save_plan().
+
+    The arrays are memory-mapped (read-only by default), so loading is
+    independent of the size of the interpolator and the pages are shared
+    by the processes which load the same plan.
+
+    :param path: The directory of the plan
+    :param mmap_mode: (Optional) The mmap_mode of numpy.load(),
+                      None reads the arrays into memory
+    :type path: string
+    :type mmap_mode: string or None
+    :return: self: instance
+    """
+    with open(os.path.join(path, 'plan.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != PLAN_VERSION:
+        raise ValueError('the plan version %s is not supported (expected %d)'
+                         % (meta['version'], PLAN_VERSION))
+    arrays = {}
+    for key in meta['arrays']:
+        arrays[key] = numpy.load(os.path.join(path, key + '.npy'),
+                                 mmap_mode=mmap_mode)
+
+    self.Nd = tuple(meta['Nd'])
+    self.Kd = tuple(meta['Kd'])
+    self.Jd = tuple(meta['Jd'])
+    self.ndims = len(self.Nd)
+    self.ft_axes = tuple(meta['ft_axes'])
+    self.st = {'Nd': self.Nd, 'Kd': self.Kd, 'Jd': self.Jd,
+               'M': meta['M'], 'om': arrays['om']}
+
+    self.threads = helper.cpu_threads(meta['threads'])
+    self.fft_backend = meta['fft_backend']
+    self.fftn, self.ifftn = helper.fft_backend(self.fft_backend, self.threads)
+    self.preserve_dtype = meta['preserve_dtype']
+    self.format = 'CSR'
+    self.real = False
+    if meta['hybrid'] is None:
+        self.hybrid = False
+    else:
+        self._set_hybrid_cpu(meta['hybrid']['Nd'], meta['hybrid']['ft_axes'],
+                             meta['hybrid']['batch'])
+    self.reorder = meta['reorder']
+    self.kernel = meta['kernel']
+    self.pruned_fft = meta['pruned_fft']
+    if self.reorder is not None:
+        self.sample_order = arrays['sample_order']
+
+    snd = [arrays['snd%d' % dimid] for dimid in range(0, self.ndims)]
+    self.tensor_sn = helper.Tensor_sn(snd, 1, self.Kd, self.Jd)
+    self._set_batch_cpu(meta['batch'])
+
+    shape = (meta['M'], int(numpy.prod(self.Kd)))
+    self.sp = scipy.sparse.csr_matrix(
+        (arrays['sp_data'], arrays['sp_indices'], arrays['sp_indptr']),
+        shape=shape, copy=False)
+    if 'spH_data' in arrays:
+        self.spH = scipy.sparse.csr_matrix(
+            (arrays['spH_data'], arrays['spH_indices'], arrays['spH_indptr']),
+            shape=shape[::-1], copy=False)
+    else:
+        self.spH = None
+    self.interp_dtype = self.sp.dtype
+
+    self.Kdprod = numpy.int32(numpy.prod(self.Kd))
+    self.Jdprod = numpy.int32(numpy.prod(self.Jd))
+    self.Nd_slice = tuple(slice(0, N) for N in self.Nd)
+
+    self._allocate_cpu(meta['gridding'])
+
+    self.toeplitz = meta['toeplitz']
+    if self.toeplitz:
+        kernel = arrays['toeplitz_kernel']
+        if self.parallel_flag == 1:
+            kernel = numpy.reshape(kernel, kernel.shape + (1, ))
+        self.toeplitz_kernel = kernel
+        self.x_2Nd = numpy.zeros(kernel.shape[:self.ndims]
+                                 + self.multi_Nd[self.ndims:],
+                                 dtype=self.dtype, order='C')
+        self.Nd_slice = tuple(slice(0, N) for N in self.Nd)
+
+    self.gram = meta['gram']
+    self.spHsp = None  # computed by _precompute_gram_cpu()
+    self.plan_handle = None
+
+
+@_locked
+def _update_plan_cpu(self, add_om=None, remove_rows=None, max_memory=None):
+    """
+    Update the plan after the samples are appended or removed.
+
+    Only the interpolator rows of add_om are computed, with the min-max
+    parameters (alpha, beta and nufft_T) of the plan, and spliced into sp.
+    The scaling factor sn does not depend on om and is kept.
+    The removed samples are dropped from y, and the samples of add_om are
+    appended at the end of y.
+
+    :param add_om: (Optional) The new samples, matrix size = M_add * ndims
+    :param remove_rows: (Optional) The indices (or a boolean mask)
+                        of the samples of y to be removed
+    :param max_memory: (Optional) The approximate bytes of the temporary
+                       arrays of the new rows, see plan()
+    :type add_om: None or numpy.float array
+    :type remove_rows: None, int array or bool array
+    :type max_memory: None or int
+    :return: self: instance
+    """
+    self._wait_plan_cpu()
+    if self.format != 'CSR' or self.real:
+        raise ValueError("update_plan requires format='CSR' and real=False")
+    om = numpy.asarray(self.st['om'])
+    keep = numpy.ones(om.shape[0], dtype=bool)
+    if remove_rows is not None:
+        keep[remove_rows] = False
+    if add_om is None:
+        add_om = numpy.empty((0, self.ndims), dtype=om.dtype)
+    add_om = numpy.reshape(numpy.asarray(add_om, dtype=om.dtype),
+                           (-1, self.ndims))
+
+    if 'alpha' not in self.st:  # loaded by load_plan()
+        fits = [helper.nufft_alpha_kb_fit(self.Nd[d], self.st['Jd'][d],
+                                          self.Kd[d])
+                for d in range(0, self.ndims)]
+        self.st['alpha'] = [fit[0] for fit in fits]
+        self.st['beta'] = [fit[1] for fit in fits]
+    ft_flag = tuple(d in tuple(self.ft_axes) for d in range(0, self.ndims))
+    otf = helper.OnTheFly(add_om, self.Nd, self.Kd, self.st['Jd'], ft_flag,
+                          self.st['alpha'], self.st['beta'],
+                          T=self.st.get('T'), kernel=self.kernel)
+    self.st['T'] = otf.T
+    rows = helper.create_csr_chunks(otf, self.Kd, max_memory=max_memory,
+                                    pool=self.pool, dtype=self.sp.dtype)
+
+    # the rows of sp are in the order of sample_order
+    if self.reorder is None:
+        keep_rows = keep
+    else:
+        keep_rows = keep[self.sample_order]
+        new_index = numpy.cumsum(keep) - 1
+        M_keep = int(numpy.sum(keep))
+        self.sample_order = numpy.concatenate(
+            (new_index[self.sample_order[keep_rows]],
+             numpy.arange(M_keep, M_keep + add_om.shape[0])))
+    self.sp = helper.splice_csr(self.sp, rows, keep_rows)
+    if self.spH is not None:
+        # the transposition of the spliced sp is faster than
+        # splicing the columns of spH
+        self.spH = self.sp.getH().tocsr()
+
+    self.st['om'] = numpy.concatenate((om[keep], add_om))
+    self.st['M'] = numpy.int32(self.st['om'].shape[0])
+    if self.parallel_flag == 1:
+        self._set_batch_cpu(self.batch)
+    else:
+        self._set_batch_cpu(None)
+    if self.pool is not None:
+        self.pool.shutdown()
+    if self.gridding is None:
+        self._allocate_cpu('auto')
+    else:
+        self._allocate_cpu(self.gridding)
+
+    if self.toeplitz:
+        self._precompute_toeplitz_cpu()
+    self.spHsp = None  # computed by _precompute_gram_cpu()
+
+
+@_locked
 def _solve_cpu(self, y, solver=None, *args, **kwargs):
     """
     Solve NUFFT_cpu.
@@ -160,36 +862,56 @@ def _solve_cpu(self, y, solver=None, *args, **kwargs):
             The shape = Nd ('L1TVOLS') or  Nd
             ('lsmr', 'lsqr', 'dc','bicg','bicgstab','cg', 'gmres','lgmres')
     """
+    self._wait_plan_cpu()
+    if self.real:
+        raise ValueError('solve requires real=False')
     from ..linalg.solve_cpu import solve
+    if self.hybrid:
+        y = numpy.reshape(y, self.multi_M)
+        return self._hybrid2x_cpu(solve(self, y, solver, *args, **kwargs))
     x2 = solve(self,  y,  solver, *args, **kwargs)
     return x2  # solve(self,  y,  solver, *args, **kwargs)
 
 
-def _forward_cpu(self, x):
+@_locked
+def _forward_cpu(self, x, out=None):
     """
     Forward NUFFT on CPU
 
     :param x: The input numpy array, with the size of Nd
+    :param out: (Optional) The output array, with the size of (M,)
     :type: numpy array with the dtype of numpy.complex64
     :return: y: The output numpy array, with the size of (M,)
     :rtype: numpy array with the dtype of numpy.complex64
     """
-    y = self._k2y_cpu(self._xx2k_cpu(self._x2xx_cpu(x)))
+    self._wait_plan_cpu()
+    if self.hybrid:
+        y = self._k2y_cpu(self._x2k_cpu(self._x2hybrid_cpu(x),
+                                        out=self.k_Kd))
+        return self._hybrid2y_cpu(y, out=out)
+    y = self._k2y_cpu(self._x2k_cpu(x, out=self.k_Kd), out=out)
 
     return y
 
 
-def _adjoint_cpu(self, y):
+@_locked
+def _adjoint_cpu(self, y, out=None):
     """
     Adjoint NUFFT on CPU
 
     :param y: The input numpy array, with the size of (M,)
+    :param out: (Optional) The output array, with the size of Nd
     :type: numpy array with the dtype of numpy.complex64
     :return: x: The output numpy array,
                 with the size of Nd or Nd
     :rtype: numpy array with the dtype of numpy.complex64
     """
-    x = self._xx2x_cpu(self._k2xx_cpu(self._y2k_cpu(y)))
+    self._wait_plan_cpu()
+    if self.hybrid:
+        y = numpy.reshape(y, self.multi_M)
+        x = self._k2x_cpu(self._y2k_cpu(y, out=self.k_Kd))
+        return self._hybrid2x_cpu(x, out=out)
+    x = self._k2x_cpu(self._y2k_cpu(y, out=self.k_Kd), out=out)
 
     return x
 
@@ -201,19 +923,53 @@ def _selfadjoint_one2many2one_cpu_deprecated(self, x):
     return x2
 
 
-def _selfadjoint_cpu(self, x):
+@_locked
+def _selfadjoint_cpu(self, x, out=None):
     """
     selfadjoint NUFFT on CPU
 
     :param x: The input numpy array, with size=Nd
+    :param out: (Optional) The output array, with size=Nd
     :type: numpy array with dtype =numpy.complex64
     :return: x: The output numpy array, with size=Nd
     :rtype: numpy array with dtype =numpy.complex64
     """
+    self._wait_plan_cpu()
+    if self.hybrid:
+        x = self._x2hybrid_cpu(x)
+        (out, hybrid_out) = (None, out)
     # x2 = self.adjoint(self.forward(x))
+    if self.toeplitz:
+        x2 = self._selfadjoint_toeplitz_cpu(x, out=out)
+    else:
+        k = self._x2k_cpu(x, out=self.k_Kd)
+        k = self._k2y2k_cpu(k, out=self.k_Kd)
+        x2 = self._k2x_cpu(k, out=out)
+    if self.hybrid:
+        x2 = self._hybrid2x_cpu(x2, out=hybrid_out)
+
+    return x2
 
-    x2 = self._xx2x_cpu(self._k2xx_cpu(self._k2y2k_cpu(self._xx2k_cpu(self._x2xx_cpu(x)))))
 
+def _selfadjoint_toeplitz_cpu(self, x, out=None):
+    """
+    Private: selfadjoint NUFFT by the Toeplitz kernel on CPU
+
+    Zero-pad x to 2*Nd, FFT, multiply by the kernel, IFFT and crop Nd.
+    """
+    self.x_2Nd.fill(0)
+    self.x_2Nd[self.Nd_slice] = x
+    k = self.fftn(self.x_2Nd, axes=range(0, self.ndims), overwrite_x=True)
+    k *= self.toeplitz_kernel
+    xx = self.ifftn(k, axes=range(0, self.ndims), overwrite_x=True)
+    xx = xx[self.Nd_slice]
+    if self.real:
+        xx = xx.real
+    if out is None:
+        x2 = numpy.array(xx, dtype=self.x_Nd.dtype, order='C')
+    else:
+        x2 = out
+        x2[...] = xx
     return x2
 
 
@@ -226,84 +982,295 @@ def _selfadjoint2_cpu(self, x):
     return x2
 
 
-def _x2xx_cpu(self, x):
+def _x2xx_cpu(self, x, out=None):
     """
     Private: Scaling on CPU
-    Inplace multiplication of self.x_Nd by the scaling factor self.sn.
+    Inplace multiplication of self.x_Nd by the separable scaling factor
+    self.tensor_sn.
     """
-    xx = x * self.sn
+    xx = self.tensor_sn.multiply(x, out=out, dtype=self.x_Nd.dtype)
     return xx
 
 
-def _xx2k_cpu(self, xx):
+def _xx2k_cpu(self, xx, out=None):
     """
     Private: oversampled FFT on CPU
 
     Firstly, zeroing the self.k_Kd array
-    Second, copy self.x_Nd array to self.k_Kd array by cSelect
+    Second, copy self.x_Nd array to the corner Nd of self.k_Kd (a slice)
     Third, inplace FFT
+
+    If out (C-contiguous, e.g. self.k_Kd) is given, it is re-zeroed and
+    transformed in place (if the FFT backend supports in-place FFT).
     """
+    if self.real:
+        return self._xx2k_real_cpu(xx, out=out)
+    if self.pruned_fft:
+        return self._xx2k_pruned_cpu(xx, out=out)
 
-    output_x = numpy.zeros(self.Kd, dtype=self.dtype, order='C')
+    if out is None:
+        output_x = numpy.zeros(self.multi_Kd, dtype=self.dtype, order='C')
+    else:
+        output_x = out
+        output_x.fill(0)
 
-    for bat in range(0, self.batch):
-        output_x.ravel()[self.KdCPUorder * self.batch + bat] = xx.ravel()[
-            self.NdCPUorder * self.batch + bat]
+    output_x[self.Nd_slice] = xx
 
-    k = numpy.fft.fftn(output_x, axes=self.ft_axes)
+    k = self.fftn(output_x, axes=self.ft_axes, overwrite_x=True)
+    if out is not None:
+        if not numpy.may_share_memory(k, out):  # no in-place FFT
+            out[...] = k
+        k = out
 
     return k
 
 
+def _xx2k_pruned_cpu(self, xx, out=None, overwrite_xx=False):
+    """
+    Private: pruned oversampled FFT on CPU
+
+    The image occupies the corner Nd of the Kd grid (see
+    helper.preindex_copy), so the 1D FFT of each axis is zero-padded from
+    N to K over the lines which are not zero: over the Nd image for the
+    first axis, and over Kd along the transformed axes for the next ones.
+    For Kd = 2 * Nd, the FFT costs 3/4 (2D) or 7/12 (3D) of the full fftn.
+    xx may be already zero-padded along the first axis of ft_axes,
+    and is overwritten if overwrite_xx is True.
+    """
+    k = xx
+    for axis in self.ft_axes:
+        k = self.fftn(k, s=(self.Kd[axis], ), axes=(axis, ),
+                      overwrite_x=overwrite_xx or k is not xx)
+    if k.shape != self.multi_Kd:
+        # zero-pad the axes without FFT
+        if out is None:
+            out = numpy.zeros(self.multi_Kd, dtype=self.dtype, order='C')
+        else:
+            out.fill(0)
+        out[tuple(slice(0, n) for n in k.shape)] = k
+    elif out is None:
+        out = numpy.asarray(k, dtype=self.dtype, order='C')
+    else:
+        out[...] = k
+    return out
+
+
+def _xx2k_real_cpu(self, xx, out=None):
+    """
+    Private: oversampled real FFT on CPU
+
+    The half spectrum of the real image, with the last axis of ft_axes
+    cropped to K // 2 + 1 (see helper.Hermitian_CSR).
+    If self.pruned_fft, the rfft of the last axis runs over the lines of
+    the image, before the FFT of the other axes.
+    """
+    axes = tuple(self.ft_axes)
+    if self.pruned_fft:
+        k = self.rfftn(xx, s=(self.Kd[axes[-1]], ), axes=(axes[-1], ))
+        for axis in axes[:-1]:
+            k = self.fftn(k, s=(self.Kd[axis], ), axes=(axis, ),
+                          overwrite_x=True)
+    else:
+        k = self.rfftn(xx, s=tuple(self.Kd[axis] for axis in axes),
+                       axes=axes)
+    if out is None:
+        out = numpy.zeros(self.multi_Kh, dtype=self.dtype, order='C')
+    elif k.shape != self.multi_Kh:
+        out.fill(0)  # zero-pad the axes without FFT
+    out[tuple(slice(0, n) for n in k.shape)] = k
+    return out
+
+
+def _ifft_real_cpu(self, k):
+    """
+    Private: inverse real FFT on CPU
+
+    The reverse of _xx2k_real(): the inverse FFT of the other axes
+    (cropped to N if self.pruned_fft), then the irfft of the last axis.
+    Return the view of the real image (Nd or Nd + (batch, )).
+    """
+    axes = tuple(self.ft_axes)
+    if self.pruned_fft:
+        overwrite_x = numpy.may_share_memory(k, self.k_Kd)
+        for axis in axes[-2::-1]:
+            crop = [slice(None), ] * k.ndim
+            crop[axis] = slice(0, self.Nd[axis])
+            k = self.ifftn(k, axes=(axis, ),
+                           overwrite_x=overwrite_x)[tuple(crop)]
+            overwrite_x = True
+        xx = self.irfftn(k, s=(self.Kd[axes[-1]], ), axes=(axes[-1], ))
+    else:
+        xx = self.irfftn(k, s=tuple(self.Kd[axis] for axis in axes),
+                         axes=axes)
+    return xx[self.Nd_slice]
+
+
+def _ifft_pruned_cpu(self, k):
+    """
+    Private: pruned inverse FFT on CPU
+
+    The reverse of _xx2k_pruned(): the inverse FFT of each axis is cropped
+    to N at once, so the next axes are transformed over the kept lines only.
+    Return the view of the image (Nd or Nd + (batch, )).
+    """
+    overwrite_x = numpy.may_share_memory(k, self.k_Kd)
+    for axis in tuple(self.ft_axes)[::-1]:
+        crop = [slice(None), ] * k.ndim
+        crop[axis] = slice(0, self.Nd[axis])
+        k = self.ifftn(k, axes=(axis, ), overwrite_x=overwrite_x)[tuple(crop)]
+        overwrite_x = True  # the temporary array of the previous axis
+    return k[self.Nd_slice]
+
+
+def _k2xx_pruned_cpu(self, k, out=None):
+    """
+    Private: pruned inverse FFT and image cropping on CPU
+    """
+    k = self._ifft_pruned_cpu(k)
+    if out is None:
+        xx = numpy.array(k, dtype=self.dtype, order='C')
+    else:
+        xx = out
+        xx[...] = k
+    return xx
+
+
+@_locked
+def _x2k_cpu(self, x, out=None):
+    """
+    Private: scaling and oversampled FFT (x2xx and xx2k) on CPU
+
+    The scaled image is written into the corner Nd of out (a slice), or,
+    if self.pruned_fft, into the image zero-padded along the first axis
+    of ft_axes, whose 1D FFT is computed in place. So the image is read
+    once and no Nd workspace is used (except for real=True).
+    """
+    if self.real:
+        return self._xx2k_real_cpu(self._x2xx_cpu(x, out=self.x_Nd), out=out)
+    if self.pruned_fft:
+        axis = tuple(self.ft_axes)[0]
+        shape = list(self.multi_Nd)
+        shape[axis] = self.Kd[axis]
+        xx = numpy.empty(shape, dtype=self.dtype, order='C')
+        index = (slice(None), ) * axis
+        xx[index + (slice(self.Nd[axis], None), )] = 0
+        self.tensor_sn.multiply(
+            x, out=xx[index + (slice(0, self.Nd[axis]), )], dtype=self.dtype)
+        return self._xx2k_pruned_cpu(xx, out=out, overwrite_xx=True)
+    if out is None:
+        output_x = numpy.zeros(self.multi_Kd, dtype=self.dtype, order='C')
+    else:
+        output_x = out
+        output_x.fill(0)
+    self.tensor_sn.multiply(x, out=output_x[self.Nd_slice], dtype=self.dtype)
+
+    k = self.fftn(output_x, axes=self.ft_axes, overwrite_x=True)
+    if out is not None:
+        if not numpy.may_share_memory(k, out):  # no in-place FFT
+            out[...] = k
+        k = out
+    return k
+
+
+@_locked
+def _k2x_cpu(self, k, out=None):
+    """
+    Private: inverse FFT, cropping and rescaling (k2xx and xx2x) on CPU
+
+    The cropped view of the inverse FFT is rescaled into out in one pass.
+    """
+    if self.real:
+        xx = self._ifft_real_cpu(k)
+    elif self.pruned_fft:
+        xx = self._ifft_pruned_cpu(k)
+    else:
+        xx = self.ifftn(k, axes=self.ft_axes,
+                        overwrite_x=numpy.may_share_memory(k, self.k_Kd))
+        xx = xx[self.Nd_slice]
+    x = self.tensor_sn.multiply(xx, out=out, dtype=self.x_Nd.dtype)
+    return x
+
+
 def _xx2k_one2one_cpu(self, xx):
     """
     Private: oversampled FFT on CPU
 
     First, zeroing the self.k_Kd array
-    Second, copy self.x_Nd array to self.k_Kd array by cSelect
+    Second, copy self.x_Nd array to the corner Nd of self.k_Kd (a slice)
     Third, inplace FFT
     """
 
     output_x = numpy.zeros(self.st['Kd'], dtype=self.dtype, order='C')
 
-    # for bat in range(0, self.batch):
-    output_x.ravel()[self.KdCPUorder] = xx.ravel()[self.NdCPUorder]
+    output_x[self.Nd_slice] = xx
 
-    k = numpy.fft.fftn(output_x, axes=self.ft_axes)
+    k = self.fftn(output_x, axes=self.ft_axes, overwrite_x=True)
 
     return k
 
 
 def _k2vec_cpu(self, k):
-    k_vec = numpy.reshape(k, self.prodKd, order='C')
+    k_vec = numpy.reshape(k, (-1, ) + self.multi_M[1:], order='C')
     return k_vec
 
 
-def _vec2y_cpu(self, k_vec):
+def _vec2y_cpu(self, k_vec, out=None):
     '''
     gridding:
+    multi-threaded over the row blocks of sp if self.threads > 1
     '''
-    y = self.sp.dot(k_vec)
+    if self.real:
+        y = self.interpolator.spmv(k_vec, out=out, pool=self.pool)
+    elif self.format != 'CSR':
+        y = self.interpolator.spmv(k_vec, out=out, dtype=self.interp_dtype,
+                                   pool=self.pool)
+    elif self.pool is None:
+        y = helper.spmv(self.sp, k_vec, out=out)
+    else:
+        y = self.sp_blocks.spmv(k_vec, out=out, pool=self.pool)
     # y = self.st['ell'].spmv(k_vec)
 
     return y
 
 
-def _k2y_cpu(self, k):
+@_locked
+def _k2y_cpu(self, k, out=None):
     """
     Private: interpolation by the Sparse Matrix-Vector Multiplication
     """
-    y = self._vec2y_cpu(self._k2vec_cpu(k))
+    if self.reorder is None:
+        y = self._vec2y_cpu(self._k2vec_cpu(k), out=out)
+    else:
+        # interpolate in the sorted order, then restore the order of om
+        y = self._vec2y_cpu(self._k2vec_cpu(k), out=self.y_M)
+        if out is None:
+            out = numpy.empty_like(y)
+        out[self.sample_order] = y
+        y = out
     # numpy.reshape(self.st['p'].dot(Xk), (self.st['M'], ), order='F')
     return y
 
 
-def _y2vec_cpu(self, y):
+def _y2vec_cpu(self, y, out=None):
     '''
    regridding non-uniform data (unsorted vector)
     '''
     # k_vec = self.st['p'].getH().dot(y)
-    k_vec = self.spH.dot(y)
+    # cast y to the interpolator, so single precision stays single precision
+    if self.real:
+        k_vec = self.interpolator.spmvH(y, out=out, pool=self.pool)
+    elif self.format != 'CSR':
+        k_vec = self.interpolator.spmvH(y, int(self.Kdprod), out=out,
+                                        dtype=self.interp_dtype)
+    elif self.pool is None and self.spH is None:
+        k_vec = helper.spmvH(self.sp, y, out=out)
+    elif self.pool is None:
+        k_vec = helper.spmv(self.spH, numpy.asarray(y, dtype=self.spH.dtype),
+                            out=out)
+    elif self.gridding == 'partial':
+        k_vec = self.sp_blocks.spmvH(y, out=out, pool=self.pool)
+    else:
+        k_vec = self.spH_blocks.spmv(y, out=out, pool=self.pool)
     # k_vec = self.st['ell'].spmvH(y)
 
     return k_vec
@@ -313,33 +1280,53 @@ def _vec2k_cpu(self, k_vec):
     '''
     Sorting the vector to k-spectrum Kd array
     '''
-    k = numpy.reshape(k_vec, self.Kd, order='C')
+    k = numpy.reshape(k_vec, self.multi_Kh, order='C')
 
     return k
 
 
-def _y2k_cpu(self, y):
+@_locked
+def _y2k_cpu(self, y, out=None):
     """
     Private: gridding by the Sparse Matrix-Vector Multiplication
     """
-    k_vec = self._y2vec_cpu(y)
+    if self.reorder is not None:
+        # y in the sorted order of the interpolator
+        y = numpy.take(numpy.asarray(y, dtype=self.y_M.dtype),
+                       self.sample_order, axis=0, out=self.y_M)
+    if out is None:
+        k_vec = self._y2vec_cpu(y)
+    else:
+        k_vec = self._y2vec_cpu(y, out=self._k2vec_cpu(out))
     k = self._vec2k_cpu(k_vec)
     return k
 
 
-def _k2xx_cpu(self, k):
+def _k2xx_cpu(self, k, out=None):
     """
     Private: the inverse FFT and image cropping (which is the reverse of
              _xx2k() method)
+
+    The workspace self.k_Kd is transformed in place;
+    other input arrays are left untouched.
     """
+    if self.real:
+        k = self._ifft_real_cpu(k)
+        if out is None:
+            return numpy.array(k, dtype=self.x_Nd.dtype, order='C')
+        out[...] = k
+        return out
+    if self.pruned_fft:
+        return self._k2xx_pruned_cpu(k, out=out)
 #         dd = numpy.size(self.Kd)
 
-    k = numpy.fft.ifftn(k, axes=self.ft_axes)
-    xx = numpy.zeros(self.Nd, dtype=self.dtype, order='C')
-    for bat in range(0, self.batch):
-        xx.ravel()[self.NdCPUorder * self.batch + bat] = k.ravel()[
-            self.KdCPUorder * self.batch + bat]
-#         xx = xx[crop_slice_ind(self.Nd)]
+    k = self.ifftn(k, axes=self.ft_axes,
+                   overwrite_x=numpy.may_share_memory(k, self.k_Kd))
+    if out is None:
+        xx = numpy.array(k[self.Nd_slice], dtype=self.dtype, order='C')
+    else:
+        xx = out
+        xx[...] = k[self.Nd_slice]
     return xx
 
 
@@ -350,30 +1337,43 @@ def _k2xx_one2one_cpu(self, k):
     """
 #         dd = numpy.size(self.Kd)
 
-    k = numpy.fft.ifftn(k, axes=self.ft_axes)
-    xx = numpy.zeros(self.st['Nd'], dtype=self.dtype, order='C')
-    # for bat in range(0, self.batch):
-    xx.ravel()[self.NdCPUorder] = k.ravel()[self.KdCPUorder]
-    # xx = xx[crop_slice_ind(self.Nd)]
+    k = self.ifftn(k, axes=self.ft_axes)
+    xx = numpy.array(k[self.Nd_slice], dtype=self.dtype, order='C')
     return xx
 
 
-def _xx2x_cpu(self, xx):
+def _xx2x_cpu(self, xx, out=None):
     """
     Private: rescaling, which is identical to the  _x2xx() method
     """
-    x = self._x2xx_cpu(xx)
+    x = self._x2xx_cpu(xx, out=out)
     return x
 
 
-def _k2y2k_cpu(self, k):
+@_locked
+def _k2y2k_cpu(self, k, out=None):
     """
     Private: the integrated interpolation-gridding by the Sparse
              Matrix-Vector Multiplication
+
+    The intermediate y is kept in the workspace self.y_M, so out may be
+    the same array as k.
+    If self.gram is set, the cached spHsp replaces the two products.
     """
 
+    if self.gram and self.spHsp is None:
+        self._precompute_gram_cpu()
+
     Xk = self._k2vec_cpu(k)
-    k = self._y2vec_cpu(self._vec2y_cpu(Xk))
+    if out is None:
+        k_vec = None
+    else:
+        k_vec = self._k2vec_cpu(out)
+    if self.spHsp is not None:
+        k = helper.spmv(self.spHsp, Xk, out=k_vec)
+    else:
+        y = self._vec2y_cpu(Xk, out=self.y_M)
+        k = self._y2vec_cpu(y, out=k_vec)
     k = self._vec2k_cpu(k)
     return k
 
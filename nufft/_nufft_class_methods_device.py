@@ -675,7 +675,7 @@ def _solve_legacy(self, gy, solver=None, *args, **kwargs):
     return solve2(self,  gy,  solver, *args, **kwargs)
 
 
-def _plan_legacy(self, om, Nd, Kd, Jd, ft_axes=None):
+def _plan_legacy(self, om, Nd, Kd, Jd, ft_axes=None, store_spH=True):
     """
     Design the min-max interpolator.
 
@@ -683,10 +683,12 @@ def _plan_legacy(self, om, Nd, Kd, Jd, ft_axes=None):
     :param Nd: The matrix size of equispaced image. Example: Nd=(256,256) for a 2D image; Nd = (128,128,128) for a 3D image
     :param Kd: The matrix size of the oversampled frequency grid. Example: Kd=(512,512) for 2D image; Kd = (256,256,256) for a 3D image
     :param Jd: The interpolator size. Example: Jd=(6,6) for 2D image; Jd = (6,6,6) for a 3D image
+    :param store_spH: (Optional) Store the adjoint interpolator spH. If False, y2k() scatters the rows of sp by atomic additions.
     :type om: numpy.float array, matrix size = M * ndims
     :type Nd: tuple, ndims integer elements.
     :type Kd: tuple, ndims integer elements.
     :type Jd: tuple, ndims integer elements.
+    :type store_spH: bool
     :returns: 0
     :rtype: int, float
     :Example:
@@ -738,8 +740,11 @@ def _plan_legacy(self, om, Nd, Kd, Jd, ft_axes=None):
     # only return the Kd_elements
     self.Kd_elements = helper.strides_divide_itemsize(self.st['Kd'])[0]
 
-    self.sp = self.st['p'].copy().tocsr()
-    self.spH = (self.st['p'].getH().copy()).tocsr()
+    self.sp = self.st['p'].tocsr()
+    if store_spH:
+        self.spH = self.sp.getH().tocsr()
+    else:
+        self.spH = None
 
     self._offload_legacy()
 
@@ -827,10 +832,13 @@ def _offload_legacy(self):
 
     del self.sp
 
-    self.csrH['data'] = self.thr.to_device(self.spH.data.astype(self.dtype))
-    self.csrH['indices'] = self.thr.to_device(self.spH.indices.astype(numpy.uint32))
-    self.csrH['indptr'] = self.thr.to_device(self.spH.indptr.astype(numpy.uint32))
-    self.csrH['numrow'] = self.Kdprod
+    if self.spH is None:
+        self.csrH = None  # y2k() scatters the rows of self.csr
+    else:
+        self.csrH['data'] = self.thr.to_device(self.spH.data.astype(self.dtype))
+        self.csrH['indices'] = self.thr.to_device(self.spH.indices.astype(numpy.uint32))
+        self.csrH['indptr'] = self.thr.to_device(self.spH.indptr.astype(numpy.uint32))
+        self.csrH['numrow'] = self.Kdprod
 
     del self.spH
 
@@ -869,6 +877,21 @@ def _y2k_legacy(self, y):
     Private: gridding by the Sparse Matrix-Vector Multiplication
     """
     k = self.thr.array(self.Kd, dtype=self.dtype)
+    if self.csrH is None:
+        k.fill(0)
+        self.prg.cCSR_spmvh_vector(
+            self.batch,
+            self.csr['numrow'],
+            self.csr['indptr'],
+            self.csr['indices'],
+            self.csr['data'],
+            k,
+            y,
+            local_size=int(self.wavefront),
+            global_size=int(self.csr['numrow']*self.wavefront*self.batch)
+        )
+        self.thr.synchronize()
+        return k
 
     self.prg.cCSR_spmv_vector(
         self.batch,
@@ -4,16 +4,130 @@ Helper functions
 """
 
 
+import os
+import json
+import shutil
+import hashlib
+import threading
+import functools
+import collections
 import scipy
+import scipy.sparse
+import concurrent.futures
 import numpy
+try:
+    from scipy.sparse import _sparsetools
+except ImportError:  # scipy < 1.8
+    from scipy.sparse import sparsetools as _sparsetools
 dtype = numpy.complex64
 
 
-def create_laplacian_kernel(nufft):
+def _memo_key(value):
+    """
+    The hashable key of the arguments of a Memo function
+    """
+    if isinstance(value, numpy.ndarray):
+        return (value.shape, value.dtype.str, value.tobytes())
+    if isinstance(value, (list, tuple)):
+        return tuple(_memo_key(item) for item in value)
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def _read_only(value):
+    """
+    Protect the cached arrays of a Memo function from in-place changes
+    """
+    if isinstance(value, numpy.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _read_only(item)
+    return value
+
+
+class Memo:
+    """
+    class Memo: bounded memo cache of a planning function,
+    whose arguments are the geometry (N, J, K) and its 1D parameters.
+    The cached arrays are read-only and shared by all plans.
+    """
+
+    def __init__(self, func, maxsize=128):
+        """
+        Constructor
+
+        :param func: The function
+        :param maxsize: The number of the cached results (least recently used
+                        results are removed)
+        :type maxsize: int
+        :returns: Memo: the memoized function
+        :rtype: Memo: Memo class
+        """
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+        key = _memo_key(args)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+        value = _read_only(self.func(*args))
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = value
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return value
+
+    def cache_clear(self):
+        """
+        Empty the cache.
+        """
+        with self.lock:
+            self.cache.clear()
+
+
+def memoize(maxsize=128):
+    """
+    Decorator of the Memo functions, see clear_memo()
+    """
+    def decorator(func):
+        memo = Memo(func, maxsize)
+        _memos.append(memo)
+        return memo
+    return decorator
+
+
+_memos = []  # all the Memo functions of the module
+
+
+def clear_memo():
+    """
+    Release the cached results of the planning functions
+    (nufft_alpha_kb_fit, nufft_scale, nufft_T and interpolator_table).
+    Only the small 1D results are memoized; the scaling factors of
+    a plan are reused by plan(tensor_sn=...).
+    """
+    for memo in _memos:
+        memo.cache_clear()
+
+
+def create_laplacian_kernel(nufft, fftn=None):
     """
     Create the multi-dimensional laplacian kernel in k-space
 
     :param nufft: the NUFFT object
+    :param fftn: (Optional) the FFT function, see fft_backend().
+                 The default is numpy.fft.fftn.
     :return: uker: the multi-dimensional laplacian kernel in k-space (no fft shift used)
     :rtype: numpy ndarray
     """
@@ -43,7 +157,9 @@ def create_laplacian_kernel(nufft):
     ################################
     #    FFT of the multi-dimensional laplacian kernel
     ################################
-    uker = numpy.fft.fftn(uker)  # , self.nufftobj.st['Kd'], range(0,numpy.ndim(uker)))
+    if fftn is None:
+        fftn = numpy.fft.fftn
+    uker = fftn(uker)  # , self.nufftobj.st['Kd'], range(0,numpy.ndim(uker)))
     return uker
 
 
@@ -218,7 +334,127 @@ def OMEGA_k(J, K, omd, Kd, dimid, dd, ft_flag):
     return k_indx
 
 
-class pELL:
+def kron_factors(ud, kd, dtype=dtype):
+    """
+    The Kronecker product of the 1D interpolators of B samples,
+    in the order of khatri_rao_u() and khatri_rao_k()
+
+    :param ud: tuple of (B, Jd[d]) 1D interpolators
+    :param kd: tuple of (B, Jd[d]) 1D indices (pre-converted offsets)
+    :param dtype: The dtype of the interpolator
+    :return: indptr, indices, data: B CSR rows with prod(Jd) non-zeros each
+    """
+    B = ud[0].shape[0]
+    data = numpy.ones((B, 1), dtype=dtype)
+    indices = numpy.zeros((B, 1), dtype=numpy.int64)
+    for dimid in range(0, len(ud)):
+        data = (data[:, :, None] * ud[dimid][:, None, :]).reshape((B, -1))
+        indices = (indices[:, :, None] + kd[dimid][:, None, :]).reshape((B, -1))
+    prodJd = data.shape[1]
+    indptr = numpy.arange(0, B * prodJd + 1, prodJd, dtype=numpy.int64)
+    return (indptr, numpy.asarray(indices, dtype=numpy.int64),
+            numpy.asarray(data, dtype=dtype))
+
+
+class Kron_chunks:
+    """
+    class Kron_chunks: the CPU interpolation by chunks of samples.
+    The subclass provides nRow, prodJd and kron_chunk(m0, m1, dtype),
+    which returns the CSR rows m0:m1 of the interpolator.
+    """
+
+    def chunks(self, chunk=None):
+        """
+        The sample ranges of the CPU interpolation
+
+        :param chunk: The number of samples per chunk.
+                      The default keeps about 2^16 weights per chunk.
+        :return: list of (m0, m1)
+        """
+        if chunk is None:
+            chunk = max(1, 65536 // int(self.prodJd))
+        bounds = list(range(0, self.nRow, chunk)) + [self.nRow, ]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def spmv(self, x, out=None, dtype=dtype, pool=None, chunk=None):
+        """
+        out = A.dot(x) on the CPU.
+        The Kronecker weights are formed on the fly, one chunk of samples
+        at a time, so the M * prod(Jd) interpolator is never stored.
+
+        :param x: the dense vector (prod(Kd), ) or matrix (prod(Kd), batch)
+        :param out: (Optional) the output array, (M, ) or (M, batch)
+        :param dtype: The dtype of the computation
+        :param pool: (Optional) concurrent.futures.Executor over the chunks
+        :param chunk: (Optional) The number of samples per chunk
+        :return: out
+        """
+        x = numpy.ascontiguousarray(x, dtype=dtype)
+        N = x.shape[0]
+        if out is not None and out.dtype == dtype and out.flags.c_contiguous:
+            y = out
+        else:
+            y = numpy.empty((self.nRow, ) + x.shape[1:], dtype=dtype)
+
+        def chunk_spmv(m):
+            (m0, m1) = m
+            indptr, indices, data = self.kron_chunk(m0, m1, dtype)
+            y_chunk = y[m0:m1]
+            y_chunk.fill(0)
+            if x.ndim == 1:
+                _sparsetools.csr_matvec(m1 - m0, N, indptr, indices, data,
+                                        x, y_chunk)
+            else:
+                _sparsetools.csr_matvecs(m1 - m0, N, x.shape[1], indptr,
+                                         indices, data, x.ravel(),
+                                         y_chunk.ravel())
+
+        if pool is None:
+            for m in self.chunks(chunk):
+                chunk_spmv(m)
+        else:
+            list(pool.map(chunk_spmv, self.chunks(chunk)))
+        if out is not None and y is not out:
+            out[...] = y
+            y = out
+        return y
+
+    def spmvH(self, y, N, out=None, dtype=dtype, chunk=None):
+        """
+        out = A.conj().T.dot(y) on the CPU.
+        The chunks are scattered in turn into the output.
+
+        :param y: the dense vector (M, ) or matrix (M, batch)
+        :param N: The number of columns, prod(Kd)
+        :param out: (Optional) the output array, (N, ) or (N, batch)
+        :param dtype: The dtype of the computation
+        :param chunk: (Optional) The number of samples per chunk
+        :return: out
+        """
+        y = numpy.ascontiguousarray(y, dtype=dtype)
+        if out is not None and out.dtype == dtype and out.flags.c_contiguous:
+            x = out
+        else:
+            x = numpy.empty((N, ) + y.shape[1:], dtype=dtype)
+        x.fill(0)
+        for (m0, m1) in self.chunks(chunk):
+            indptr, indices, data = self.kron_chunk(m0, m1, dtype)
+            # the rows m0:m1 of A are the CSC columns of A^T
+            data = data.conj()
+            if y.ndim == 1:
+                _sparsetools.csc_matvec(N, m1 - m0, indptr, indices, data,
+                                        y[m0:m1], x)
+            else:
+                _sparsetools.csc_matvecs(N, m1 - m0, y.shape[1], indptr,
+                                         indices, data, y[m0:m1].ravel(),
+                                         x.ravel())
+        if out is not None and x is not out:
+            out[...] = x
+            x = out
+        return x
+
+
+class pELL(Kron_chunks):
     """
     class pELL: partial ELL format
     """
@@ -253,15 +489,123 @@ class pELL:
         self.kindx = numpy.array(kindx, order='C')
         self.udata = udata.astype(numpy.complex64)
 
+    def kron_chunk(self, m0, m1, dtype=dtype):
+        """
+        Form the Kronecker product of the 1D factors of the samples m0:m1
+
+        :param m0: The first sample
+        :param m1: The end of the samples
+        :param dtype: The dtype of the interpolator
+        :return: indptr, indices, data: the CSR rows m0:m1
+        """
+        ud = ()
+        kd = ()
+        for dimid in range(0, self.dim):
+            s0 = int(self.curr_sumJd[dimid])
+            s1 = s0 + int(self.Jd[dimid])
+            ud += (self.udata[m0:m1, s0:s1], )
+            kd += (self.kindx[m0:m1, s0:s1], )
+        return kron_factors(ud, kd, dtype)
+
+
+class OnTheFly(Kron_chunks):
+    """
+    class OnTheFly: matrix-free interpolator.
+    Only om and the min-max parameters (alpha, beta, nufft_T) are stored;
+    the interpolator of each chunk is recomputed from them in k2y/y2k.
+    """
+
+    def __init__(self, om, Nd, Kd, Jd, ft_flag, alpha, beta, T=None,
+                 kernel='minmax'):
+        """
+        Constructor
+
+        :param om: Coordinate, M * ndims
+        :param Nd: Image shape
+        :param Kd: Oversampled grid shape
+        :param Jd: Interpolator size
+        :param ft_flag: tuple of bool, True for the axes of the FFT
+        :param alpha: list of the 1D alpha of nufft_alpha_kb_fit()
+        :param beta: list of the 1D beta of nufft_alpha_kb_fit()
+        :param T: (Optional) list of the 1D nufft_T() of a previous plan
+        :param kernel: (Optional) 'minmax' (default): the exact min-max
+                       weights; 'table': the linear interpolation of
+                       interpolator_table(), see table_interp()
+        :returns: OnTheFly: the matrix-free interpolator
+        :rtype: OnTheFly: OnTheFly class
+        """
+        self.om = numpy.array(om, dtype=numpy.float64, order='C')
+        self.nRow = self.om.shape[0]
+        self.dim = len(Jd)
+        self.prodJd = numpy.prod(Jd)
+        self.Nd = Nd
+        self.Kd = Kd
+        self.Jd = Jd
+        self.ft_flag = ft_flag
+        self.alpha = alpha
+        self.beta = beta
+        self.kernel = kernel
+        if T is None:
+            T = []
+            for dimid in range(0, self.dim):
+                if ft_flag[dimid] is True:
+                    T += [nufft_T(Nd[dimid], Jd[dimid], Kd[dimid],
+                                  alpha[dimid], beta[dimid]), ]
+                else:
+                    T += [None, ]
+        self.T = T
+        self.tables = [None, ] * self.dim
+        if kernel == 'table':
+            for dimid in range(0, self.dim):
+                if ft_flag[dimid] is True:
+                    self.tables[dimid] = interpolator_table(
+                        Nd[dimid], Jd[dimid], Kd[dimid], alpha[dimid],
+                        beta[dimid])
+        elif kernel != 'minmax':
+            raise ValueError("kernel must be 'minmax' or 'table'")
+
+    def kron_chunk(self, m0, m1, dtype=dtype):
+        """
+        Compute the interpolator of the samples m0:m1, as min_max() and
+        OMEGA_k() do in plan()
+
+        :param m0: The first sample
+        :param m1: The end of the samples
+        :param dtype: The dtype of the interpolator
+        :return: indptr, indices, data: the CSR rows m0:m1
+        """
+        ud = ()
+        kd = ()
+        for dimid in range(0, self.dim):
+            N = self.Nd[dimid]
+            J = self.Jd[dimid]
+            K = self.Kd[dimid]
+            omd = self.om[m0:m1, dimid]
+            if self.tables[dimid] is not None:
+                ud += (table_interp(omd, N, J, K, self.tables[dimid]), )
+            elif self.ft_flag[dimid] is True:
+                (r, arg) = nufft_r(omd, N, J, K, self.alpha[dimid],
+                                   self.beta[dimid])
+                c = self.T[dimid].dot(r)
+                ud += (OMEGA_u(c, N, K, omd, arg, True).T.conj(), )
+            else:
+                ud += (numpy.ones((m1 - m0, 1), dtype=dtype), )
+            kd += (OMEGA_k(J, K, omd, self.Kd, dimid, self.dim,
+                           self.ft_flag[dimid]).T, )
+        return kron_factors(ud, kd, dtype)
+
 
 class Tensor_sn:
     '''
-    Not implemented:
+    The scaling factors of the groups of radix dimensions
     '''
 
-    def __init__(self, snd, radix):
+    def __init__(self, snd, radix, Kd=None, Jd=None):
         #         raise NotImplementedError
         self.radix = radix
+        # the geometry of snd, checked when the factors are shared by plans
+        self.Kd = None if Kd is None else tuple(Kd)
+        self.Jd = None if Jd is None else tuple(Jd)
         Ndims = len(snd)
         Nd = ()
         for n in range(0, Ndims):
@@ -289,6 +633,55 @@ class Tensor_sn:
 
         self.tensor_sn = tensor_sn.astype(numpy.float32)
 
+        # the factors of multiply(), broadcast over Nd
+        self.Nd = Nd
+        self.factors = []
+        for count in range(0, Tdims):
+            d_start = count*radix
+            d_end = min((count + 1)*radix, Ndims)
+            shape = (1, )*d_start + Nd[d_start:d_end] + (1, )*(Ndims - d_end)
+            self.factors += [numpy.reshape(snd2[count], shape), ]
+        # the product of the factors except the first one
+        self.plane = numpy.ones((1, ) * min(radix, Ndims) + Nd[radix:])
+        for factor in self.factors[1:]:
+            self.plane = self.plane * factor
+
+    def multiply(self, x, out=None, dtype=dtype, block=2 ** 16, inverse=False):
+        '''
+        out = x * sn, the Kronecker product of the factors, without the
+        dense sn array. x is scaled in blocks along the first axis;
+        the scaling of a block is the first factor times the product of
+        the other factors (self.plane), which is small enough to stay in
+        the cache.
+
+        :param x: The image, with the shape Nd or Nd + (batch, )
+        :param out: (Optional) The output array (may be x or a view)
+        :param dtype: The dtype of the computation
+        :param block: The approximate number of the scaling factors per block
+        :param inverse: (Optional) out = x / sn if True
+        :return: out
+        '''
+        extra = (1, ) * (numpy.ndim(x) - len(self.Nd))  # the batch axis
+        if out is None:
+            out = numpy.empty(numpy.shape(x), dtype=dtype)
+        real_dtype = numpy.finfo(dtype).dtype  # sn is real
+        plane = numpy.reshape(self.plane.astype(real_dtype),
+                              self.plane.shape + extra)
+        factor0 = numpy.reshape(self.factors[0].astype(real_dtype),
+                                self.factors[0].shape + extra)
+        if inverse:
+            plane = 1 / plane
+            factor0 = 1 / factor0
+        shape = numpy.broadcast(factor0[:1], plane).shape[1:]  # of a row
+        rows = max(1, block // int(numpy.prod(shape)))
+        scale = numpy.empty((rows, ) + shape, dtype=real_dtype)
+        for i0 in range(0, self.Nd[0], rows):
+            i1 = min(i0 + rows, self.Nd[0])
+            numpy.multiply(factor0[i0:i1], plane, out=scale[:i1 - i0])
+            numpy.multiply(x[i0:i1], scale[:i1 - i0], out=out[i0:i1],
+                           dtype=dtype)
+        return out
+
 
 def create_csr(uu, kk, Kd, Jd, M):
     #     Jprod = numpy.prod(Jd)
@@ -319,6 +712,387 @@ def create_csr(uu, kk, Kd, Jd, M):
     return csr
 
 
+def create_csr_chunks(otf, Kd, max_memory=None, pool=None,
+                      dtype=numpy.complex128):
+    """
+    Build the CSR interpolator in chunks of samples.
+    Every chunk is computed by the OnTheFly interpolator and written into
+    the preallocated data and indices arrays, so the peak memory is the
+    final CSR plus the temporary arrays of one chunk.
+
+    :param otf: The interpolator of all samples
+    :param Kd: Oversampled grid shape
+    :param max_memory: The approximate bytes of the temporary arrays
+                       of one chunk. The default is None (64 MiB).
+    :param pool: (Optional) concurrent.futures.Executor over the chunks
+    :param dtype: (Optional) The dtype of the CSR. The chunks are computed
+                  in double precision and cast into the CSR arrays.
+    :type otf: OnTheFly
+    :type Kd: tuple of int
+    :type max_memory: None or int
+    :type pool: None or concurrent.futures.Executor
+    :type dtype: numpy.dtype
+    :return: CSR: the interpolator, shape = (M, prod(Kd))
+    :rtype: CSR: scipy.sparse.csr_matrix
+    """
+    if max_memory is None:
+        max_memory = 2 ** 26
+    M = otf.nRow
+    prodJd = int(otf.prodJd)
+    prodKd = int(numpy.prod(Kd))
+    nnz = M * prodJd
+    if max(nnz, prodKd) < 2 ** 31:
+        itype = numpy.int32
+    else:
+        itype = numpy.int64
+    data = numpy.empty((nnz, ), dtype=dtype)
+    indices = numpy.empty((nnz, ), dtype=itype)
+    indptr = numpy.arange(0, nnz + 1, prodJd, dtype=itype)
+
+    # the Kronecker products of kron_factors() and the (J, chunk) arrays of
+    # nufft_r() per sample
+    sample_bytes = 64 * prodJd + 256 * int(numpy.sum(otf.Jd))
+    chunk = max(1, int(max_memory) // sample_bytes)
+
+    def fill_chunk(m):
+        (m0, m1) = m
+        (_, chunk_indices, chunk_data) = otf.kron_chunk(m0, m1, numpy.complex128)
+        data[m0 * prodJd:m1 * prodJd] = chunk_data.ravel()
+        indices[m0 * prodJd:m1 * prodJd] = chunk_indices.ravel()
+
+    if pool is None:
+        for m in otf.chunks(chunk):
+            fill_chunk(m)
+    else:
+        list(pool.map(fill_chunk, otf.chunks(chunk)))
+
+    CSR = scipy.sparse.csr_matrix((data, indices, indptr), shape=(M, prodKd))
+    return CSR
+
+
+def splice_csr(A, B, keep=None):
+    """
+    Splice the rows of two CSR matrices.
+
+    :param A: The CSR matrix
+    :param B: The CSR matrix of the appended rows, with the columns of A
+    :param keep: (Optional) The boolean mask of the rows of A to be kept.
+                 The default is None (all rows).
+    :type A: scipy.sparse.csr_matrix
+    :type B: scipy.sparse.csr_matrix
+    :type keep: None or numpy.ndarray of bool
+    :return: CSR: the kept rows of A followed by the rows of B, in A.dtype
+    :rtype: CSR: scipy.sparse.csr_matrix
+    """
+    if keep is not None:
+        A = A[numpy.flatnonzero(keep)]
+    return scipy.sparse.vstack((A, B.astype(A.dtype)), format='csr')
+
+
+def spmv(A, x, out=None):
+    """
+    Sparse matrix-vector multiplication out = A.dot(x) by scipy sparsetools,
+    which writes into the preallocated out array.
+
+    :param A: the CSR matrix, shape = (M, N)
+    :param x: the dense vector (N, ) or the dense matrix (N, batch)
+    :param out: (Optional) the output array, (M, ) or (M, batch).
+                If out does not match the dtype of A,
+                the product is computed by A.dot(x) and copied into out.
+    :type A: scipy.sparse.csr_matrix
+    :type x: numpy.ndarray
+    :type out: None or numpy.ndarray
+    :return: out
+    :rtype: numpy.ndarray
+    """
+    if out is None:
+        return A.dot(x)
+    if A.format != 'csr' or out.dtype != A.dtype or not out.flags.c_contiguous:
+        out[...] = A.dot(x)
+        return out
+    if numpy.may_share_memory(x, out):  # in-place product of a square A
+        x = x.copy()
+    x = numpy.ascontiguousarray(x, dtype=A.dtype)
+    (M, N) = A.shape
+    out.fill(0)  # sparsetools accumulates into out
+    if x.ndim == 1:
+        _sparsetools.csr_matvec(M, N, A.indptr, A.indices, A.data,
+                                x, out)
+    else:
+        _sparsetools.csr_matvecs(M, N, x.shape[1], A.indptr, A.indices,
+                                 A.data, x.ravel(), out.ravel())
+    return out
+
+
+def spmvH(A, y, out=None):
+    """
+    The adjoint product out = A.conj().T.dot(y) without the transpose of A.
+    The rows of the CSR matrix A are the columns of the CSC matrix A.T,
+    so A^H y = conj(A^T conj(y)) is computed by the CSC kernel of sparsetools.
+
+    :param A: the CSR matrix, shape = (M, N)
+    :param y: the dense vector (M, ) or the dense matrix (M, batch)
+    :param out: (Optional) the output array, (N, ) or (N, batch)
+    :type A: scipy.sparse.csr_matrix
+    :type y: numpy.ndarray
+    :type out: None or numpy.ndarray
+    :return: out
+    :rtype: numpy.ndarray
+    """
+    (M, N) = A.shape
+    # conj() copies y, so y may share memory with out
+    y = numpy.ascontiguousarray(numpy.conj(numpy.asarray(y, dtype=A.dtype)))
+    if (out is None or out.dtype != A.dtype or
+            not out.flags.c_contiguous):
+        x = numpy.zeros((N, ) + y.shape[1:], dtype=A.dtype)
+    else:
+        x = out
+        x.fill(0)  # sparsetools accumulates into out
+    if y.ndim == 1:
+        _sparsetools.csc_matvec(N, M, A.indptr, A.indices, A.data, y, x)
+    else:
+        _sparsetools.csc_matvecs(N, M, y.shape[1], A.indptr, A.indices,
+                                 A.data, y.ravel(), x.ravel())
+    numpy.conj(x, out=x)
+    if out is not None and x is not out:
+        out[...] = x
+        x = out
+    return x
+
+
+class CSR_blocks:
+    """
+    class CSR_blocks: row blocks of a CSR matrix for the multi-threaded SpMV
+    """
+
+    def __init__(self, A, nblocks):
+        """
+        Constructor
+
+        :param A: The CSR matrix
+        :type A: scipy.sparse.csr_matrix
+        :param nblocks: The number of row blocks, usually the number of threads
+        :type nblocks: int
+        :returns: CSR_blocks: row blocks with balanced numbers of non-zeros,
+                  which share data and indices with A
+        :rtype: CSR_blocks: CSR_blocks class
+        """
+        self.shape = A.shape
+        self.dtype = A.dtype
+        self.grids = None  # private grids of spmvH()
+        M = A.shape[0]
+        bounds = numpy.searchsorted(A.indptr, numpy.linspace(0, A.nnz, nblocks + 1))
+        bounds[0] = 0
+        bounds[-1] = M  # include the trailing empty rows
+        self.blocks = []
+        for (r0, r1) in zip(bounds[:-1], bounds[1:]):
+            if r1 > r0:
+                p0 = A.indptr[r0]
+                p1 = A.indptr[r1]
+                self.blocks += [(r0, r1, A.indptr[r0:r1 + 1] - p0,
+                                 A.indices[p0:p1], A.data[p0:p1]), ]
+
+    def spmv(self, x, out=None, pool=None):
+        """
+        out = A.dot(x), each row block being computed by one thread.
+        sparsetools releases the GIL, and every row is summed by the same
+        serial kernel, so the result does not depend on the number of threads.
+
+        :param x: the dense vector (N, ) or the dense matrix (N, batch)
+        :param out: (Optional) the output array, (M, ) or (M, batch)
+        :param pool: (Optional) concurrent.futures.Executor.
+                     The blocks are computed sequentially if pool is None.
+        :return: out
+        """
+        (M, N) = self.shape
+        if out is not None and numpy.may_share_memory(x, out):
+            x = x.copy()
+        x = numpy.ascontiguousarray(x, dtype=self.dtype)
+        if (out is None or out.dtype != self.dtype or
+                not out.flags.c_contiguous):
+            y = numpy.empty((M, ) + x.shape[1:], dtype=self.dtype)
+        else:
+            y = out
+
+        def block_spmv(block):
+            (r0, r1, indptr, indices, data) = block
+            y_block = y[r0:r1]
+            y_block.fill(0)  # sparsetools accumulates into y
+            if x.ndim == 1:
+                _sparsetools.csr_matvec(r1 - r0, N, indptr, indices, data,
+                                        x, y_block)
+            else:
+                _sparsetools.csr_matvecs(r1 - r0, N, x.shape[1], indptr,
+                                         indices, data, x.ravel(),
+                                         y_block.ravel())
+
+        if pool is None:
+            for block in self.blocks:
+                block_spmv(block)
+        else:
+            list(pool.map(block_spmv, self.blocks))
+        if out is not None and y is not out:
+            out[...] = y
+            y = out
+        return y
+
+    def spmvH(self, y, out=None, pool=None):
+        """
+        out = A.conj().T.dot(y), the gridding scatter of the row blocks.
+        Each thread scatters its rows into a private grid, which sees the
+        block as the CSC matrix of its transpose; the private grids are then
+        summed over the slices of the output.
+
+        :param y: the dense vector (M, ) or the dense matrix (M, batch)
+        :param out: (Optional) the output array, (N, ) or (N, batch)
+        :param pool: (Optional) concurrent.futures.Executor.
+                     The blocks are computed sequentially if pool is None.
+        :return: out
+        """
+        (M, N) = self.shape
+        # A^H y = conj(A^T conj(y)), so the data of A is not copied
+        y = numpy.ascontiguousarray(numpy.conj(numpy.asarray(y, dtype=self.dtype)))
+        grid_shape = (len(self.blocks), N) + y.shape[1:]
+        if self.grids is None or self.grids.shape != grid_shape:
+            self.grids = numpy.empty(grid_shape, dtype=self.dtype)
+        if (out is None or out.dtype != self.dtype or
+                not out.flags.c_contiguous):
+            x = numpy.empty((N, ) + y.shape[1:], dtype=self.dtype)
+        else:
+            x = out
+
+        def block_spmvH(b):
+            (r0, r1, indptr, indices, data) = self.blocks[b]
+            grid = self.grids[b]
+            grid.fill(0)
+            if y.ndim == 1:
+                _sparsetools.csc_matvec(N, r1 - r0, indptr, indices, data,
+                                        y[r0:r1], grid)
+            else:
+                _sparsetools.csc_matvecs(N, r1 - r0, y.shape[1], indptr,
+                                         indices, data, y[r0:r1].ravel(),
+                                         grid.ravel())
+
+        bounds = numpy.linspace(0, N, len(self.blocks) + 1).astype(int)
+        slices = [slice(n0, n1) for (n0, n1) in zip(bounds[:-1], bounds[1:])]
+
+        def reduce_grids(s):
+            numpy.sum(self.grids[:, s], axis=0, out=x[s])
+            numpy.conj(x[s], out=x[s])
+
+        if pool is None:
+            for b in range(len(self.blocks)):
+                block_spmvH(b)
+            for s in slices:
+                reduce_grids(s)
+        else:
+            list(pool.map(block_spmvH, range(len(self.blocks))))
+            list(pool.map(reduce_grids, slices))
+        if out is not None and x is not out:
+            out[...] = x
+            x = out
+        return x
+
+
+class Hermitian_CSR:
+    """
+    class Hermitian_CSR: the interpolator of the half spectrum of a real image
+
+    The spectrum X of a real image is Hermitian over the FFT axes,
+    X[-k] = conj(X[k]), so only the half spectrum Xh (the last FFT axis
+    cropped to K // 2 + 1) is computed by rfftn. The columns of the full
+    interpolator in the other half are mirrored into the half spectrum
+    and conjugated, and stacked below the columns in the half:
+    S = [A; C], y = A Xh + conj(C Xh) = S Xh[:M] + conj(S Xh[M:]).
+    The adjoint returns the half spectrum of the real part of the full
+    adjoint, which irfftn takes: the mirrored columns are in the interior
+    of the last axis, where the pairs X[k], conj(X[-k]) are weighted by 1/2.
+    """
+
+    def __init__(self, A, Kd, ft_axes, nblocks=1):
+        """
+        Constructor
+
+        :param A: The CSR interpolator of the full spectrum, shape = (M, prod(Kd))
+        :param Kd: The shape of the full spectrum
+        :param ft_axes: The FFT axes, the last of which is cropped
+        :param nblocks: The number of row blocks, usually the number of threads
+        :type A: scipy.sparse.csr_matrix
+        :type Kd: tuple
+        :type ft_axes: tuple
+        :type nblocks: int
+        :returns: Hermitian_CSR: the interpolator of the half spectrum
+        :rtype: Hermitian_CSR: Hermitian_CSR class
+        """
+        Kd = tuple(Kd)
+        ft_axes = tuple(ft_axes)
+        axis = ft_axes[-1]
+        Kh = Kd[:axis] + (Kd[axis] // 2 + 1, ) + Kd[axis + 1:]
+        M = A.shape[0]
+        coo = A.tocoo()
+        index = list(numpy.unravel_index(coo.col, Kd))
+        mirror = index[axis] > Kd[axis] // 2
+        for d in ft_axes:
+            index[d] = numpy.where(mirror, (-index[d]) % Kd[d], index[d])
+        S = scipy.sparse.csr_matrix(
+            (numpy.where(mirror, coo.data.conj(), coo.data),
+             (coo.row + mirror * M, numpy.ravel_multi_index(index, Kh))),
+            shape=(2 * M, int(numpy.prod(Kh))))
+        del coo, index, mirror
+
+        self.S = S
+        self.shape = (M, S.shape[1])
+        self.dtype = S.dtype
+        self.Kh = Kh
+        weight = numpy.full((Kh[axis], ), 0.5)
+        weight[0] = 1  # the self-mirrored lines
+        if Kd[axis] % 2 == 0:
+            weight[-1] = 1
+        self.weight = numpy.reshape(
+            weight, (1, ) * axis + (Kh[axis], ) + (1, ) * (len(Kd) - axis - 1))
+        if nblocks > 1:
+            self.blocks = CSR_blocks(S, nblocks)
+        else:
+            self.blocks = None
+
+    def spmv(self, x, out=None, pool=None):
+        """
+        out = A Xh + conj(C Xh), the interpolation of the half spectrum
+
+        :param x: the half spectrum (prod(Kh), ) or (prod(Kh), batch)
+        :param out: (Optional) the output array, (M, ) or (M, batch)
+        :param pool: (Optional) concurrent.futures.Executor over the row blocks
+        :return: out
+        """
+        M = self.shape[0]
+        if self.blocks is None:
+            v = spmv(self.S, x)
+        else:
+            v = self.blocks.spmv(x, pool=pool)
+        v[M:] = numpy.conj(v[M:])
+        return numpy.add(v[:M], v[M:], out=out)
+
+    def spmvH(self, y, out=None, pool=None):
+        """
+        out = the half spectrum of the real part of the adjoint
+
+        :param y: the dense vector (M, ) or the dense matrix (M, batch)
+        :param out: (Optional) the output array, (prod(Kh), ) or (prod(Kh), batch)
+        :param pool: (Optional) concurrent.futures.Executor over the row blocks
+        :return: out
+        """
+        y = numpy.asarray(y, dtype=self.dtype)
+        u = numpy.concatenate((y, numpy.conj(y)))
+        if self.blocks is None:
+            x = spmvH(self.S, u, out=out)
+        else:
+            x = self.blocks.spmvH(u, out=out, pool=pool)
+        extra = x.shape[1:]  # the batch axis
+        k = numpy.reshape(x, self.Kh + extra)
+        k *= numpy.reshape(self.weight, self.weight.shape + (1, ) * len(extra))
+        return x
+
+
 class ELL:
     """
     ELL is slow on a single core CPU
@@ -647,7 +1421,296 @@ def min_max(N, J, K, alpha, beta, om, ft_flag):
     return u2
 
 
-def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
+@memoize()
+def interpolator_table(N, J, K, alpha, beta, table_size=2 ** 12):
+    """
+    Tabulate the 1D min-max interpolator on a fine grid of offsets.
+
+    The weights of a sample om depend only on the fractional offset
+    t = om/gam - J/2 - nufft_offset(om), 0 <= t < 1, up to the phase
+    exp(-1j*om*N/2). The table holds the conjugate of the rest of
+    OMEGA_u(T.dot(r)) at t = n/table_size, n = 0, ..., table_size.
+
+    :param N: size of image
+    :param J: size of interpolator
+    :param K: size of oversampled k-space
+    :param alpha: the alpha of nufft_alpha_kb_fit()
+    :param beta: the beta of nufft_alpha_kb_fit()
+    :param table_size: the number of table intervals per grid spacing
+    :return: table: (table_size + 1, J) complex128 array
+    """
+    gam = 2.0 * numpy.pi / (K * 1.0)
+    dk = numpy.arange(0, table_size + 1) / (1.0 * table_size) + J / 2.0
+    (r, arg) = nufft_r(None, N, J, K, alpha, beta, dk=dk)
+    c = nufft_T(N, J, K, alpha, beta).dot(r)
+    phase = numpy.exp(1.0j * gam * (N * 1.0 - 1.0) / 2.0 * arg)
+    return numpy.ascontiguousarray((phase * c).T.conj())
+
+
+def table_interp(omd, N, J, K, table):
+    """
+    The 1D interpolator of omd by the linear interpolation of the table of
+    interpolator_table(), in place of OMEGA_u(...).T.conj().
+
+    The error of the linear interpolation is bounded by
+    max|d^2 u / dt^2| / (8 * table_size^2). The weights (|u| <= 1) are smooth
+    in t, max|d^2 u / dt^2| < 8 for J = 3...8 and K/N = 1.5...2, so the
+    weights of the default table_size = 2^12 are within 6e-8 of the exact
+    min-max weights (measured: 3e-8 to 5e-8), below the single precision
+    of the NUFFT.
+
+    :param omd: the 1D coordinates of the samples
+    :param N: size of image
+    :param J: size of interpolator
+    :param K: size of oversampled k-space
+    :param table: the table of interpolator_table()
+    :return: ud: (M, J) array of the interpolator
+    """
+    table_size = table.shape[0] - 1
+    gam = 2.0 * numpy.pi / (K * 1.0)
+    x = 1.0 * omd / gam - 1.0 * J / 2.0
+    t = (x - numpy.floor(x)) * table_size
+    n = numpy.minimum(t.astype(numpy.int64), table_size - 1)
+    f = (t - n).reshape((-1, 1))
+    ud = table[n] * (1.0 - f)
+    ud += table[n + 1] * f
+    ud *= numpy.exp(0.5j * N * omd).reshape((-1, 1))
+    return ud
+
+
+def _nbytes(obj):
+    """
+    The bytes of the numpy arrays held by obj (the size of a cache entry)
+    """
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    if scipy.sparse.issparse(obj):
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(item) for item in obj)
+    if hasattr(obj, '__dict__'):
+        return sum(_nbytes(item) for item in vars(obj).values())
+    return 0
+
+
+class Plan_cache:
+    """
+    class Plan_cache: two-tier cache of the interpolators of plan()
+
+    The entries are keyed by a hash of om and the geometry.
+    The memory tier is a least recently used (LRU) cache within max_bytes.
+    The disk tier (format='CSR' only) stores each entry as a directory of
+    raw .npy files under path, and removes the least recently used entries
+    when the directory exceeds max_disk_bytes.
+    """
+    fields = ('p', 'pH', 'pELL', 'otf', 'sn', 'snd', 'alpha', 'beta', 'tSN',
+              'T')
+
+    def __init__(self, max_bytes=2**30, path=None, max_disk_bytes=2**34):
+        """
+        Constructor
+
+        :param max_bytes: The budget of the memory tier in bytes
+        :param path: (Optional) The directory of the disk tier.
+                     The default is None (no disk tier).
+        :param max_disk_bytes: The budget of the disk tier in bytes
+        :type max_bytes: int
+        :type path: None or string
+        :type max_disk_bytes: int
+        :returns: Plan_cache: an empty cache
+        :rtype: Plan_cache: Plan_cache class
+        """
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.path = path
+        self.entries = collections.OrderedDict()  # key: (entry, nbytes)
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(om, Nd, Kd, Jd, ft_axes, format='CSR', radix=None,
+            kernel='minmax', dtype=numpy.complex128, adjoint=False):
+        """
+        The key of the plan: a hash of om, the geometry, the format,
+        the dtype of the interpolator and whether the adjoint is cached
+        """
+        om = numpy.ascontiguousarray(om)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((om.shape, om.dtype.str, tuple(Nd), tuple(Kd),
+                       tuple(Jd), tuple(int(d) for d in ft_axes), format,
+                       radix, kernel, numpy.dtype(dtype).str,
+                       bool(adjoint))).encode())
+        h.update(om.data)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached entry of key, or None.
+        An entry found on the disk is memory-mapped and moved to the memory tier.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+        if self.path is None:
+            return None
+        entry = self._load(key)
+        if entry is not None:
+            self._put_memory(key, entry)
+        return entry
+
+    def put(self, key, st):
+        """
+        Cache the interpolator and the scaling factors of the plan st.
+        """
+        entry = {field: st[field] for field in self.fields if field in st}
+        self._put_memory(key, entry)
+        if self.path is not None and 'p' in entry:
+            self._save(key, entry)
+            self._evict_disk(key)
+
+    def clear(self):
+        """
+        Empty the memory tier. The disk tier is kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _put_memory(self, key, entry):
+        nbytes = _nbytes(entry)
+        if nbytes > self.max_bytes:
+            return  # larger than the whole budget
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (entry, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def _save(self, key, entry):
+        final = os.path.join(self.path, key)
+        if os.path.isdir(final):
+            return
+        tmp = final + '.tmp%d' % os.getpid()
+        os.makedirs(tmp, exist_ok=True)
+        arrays = {'p_data': entry['p'].data,
+                  'p_indices': entry['p'].indices,
+                  'p_indptr': entry['p'].indptr}
+        if 'pH' in entry:
+            arrays.update({'pH_data': entry['pH'].data,
+                           'pH_indices': entry['pH'].indices,
+                           'pH_indptr': entry['pH'].indptr})
+        if 'sn' in entry:
+            arrays['sn'] = entry['sn']
+        for dimid in range(0, len(entry['snd'])):
+            arrays['snd%d' % dimid] = entry['snd'][dimid]
+            arrays['alpha%d' % dimid] = entry['alpha'][dimid]
+        for name in arrays:
+            numpy.save(os.path.join(tmp, name + '.npy'), arrays[name])
+        meta = {'shape': [int(s) for s in entry['p'].shape],
+                'beta': [int(numpy.ravel(beta)[0]) if numpy.ndim(beta)
+                         else int(beta) for beta in entry['beta']],
+                'ndims': len(entry['snd']),
+                'radix': entry['tSN'].radix,
+                'Kd': [int(K) for K in entry['tSN'].Kd],
+                'Jd': [int(J) for J in entry['tSN'].Jd],
+                'arrays': sorted(arrays)}
+        with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, final)
+        except OSError:  # saved by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load(self, key):
+        folder = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(folder, 'entry.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        def load(name):
+            return numpy.load(os.path.join(folder, name + '.npy'),
+                              mmap_mode='r')
+
+        dd = meta['ndims']
+        entry = {'p': scipy.sparse.csr_matrix(
+                     (load('p_data'), load('p_indices'), load('p_indptr')),
+                     shape=tuple(meta['shape']), copy=False),
+                 'snd': [load('snd%d' % dimid) for dimid in range(0, dd)],
+                 'alpha': [load('alpha%d' % dimid) for dimid in range(0, dd)],
+                 'beta': meta['beta']}
+        if 'pH_data' in meta['arrays']:
+            entry['pH'] = scipy.sparse.csr_matrix(
+                (load('pH_data'), load('pH_indices'), load('pH_indptr')),
+                shape=tuple(meta['shape'][::-1]), copy=False)
+        if 'sn' in meta.get('arrays', ('sn', )):  # the entries with sn
+            entry['sn'] = load('sn')
+        entry['tSN'] = Tensor_sn(entry['snd'], meta.get('radix', dd),
+                                 meta['Kd'], meta['Jd'])
+        os.utime(folder)  # the least recently used entries are evicted
+        return entry
+
+    def _evict_disk(self, keep):
+        sizes = {}
+        for key in os.listdir(self.path):
+            folder = os.path.join(self.path, key)
+            if not os.path.isdir(folder) or '.tmp' in key:
+                continue
+            sizes[key] = (os.path.getmtime(folder),
+                          sum(os.path.getsize(os.path.join(folder, name))
+                              for name in os.listdir(folder)))
+        total = sum(size for (mtime, size) in sizes.values())
+        for key in sorted(sizes, key=lambda key: sizes[key][0]):
+            if total <= self.max_disk_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+                total -= sizes[key][1]
+
+
+class Plan_handle:
+    """
+    class Plan_handle: the plan built in a worker thread
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        """
+        Constructor: start func(*args, **kwargs) in a worker thread
+
+        :returns: Plan_handle: the handle of the running plan
+        :rtype: Plan_handle: Plan_handle class
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.future = executor.submit(func, *args, **kwargs)
+        executor.shutdown(wait=False)  # the thread exits after func
+
+    def ready(self):
+        """
+        Return True if the plan is finished (or failed).
+        """
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the plan, and raise the exception of the plan if it failed.
+
+        :param timeout: (Optional) The timeout in seconds, default: None
+        :return: the return value of the plan
+        """
+        return self.future.result(timeout)
+
+
+def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None,
+         max_memory=None, threads=None, cache=None, kernel='minmax',
+         dtype=numpy.complex128, adjoint=False, tensor_sn=None):
     """
     Plan for the NUFFT object.
 
@@ -656,15 +1719,47 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
     :param Kd: Oversampled grid shape
     :param Jd: Interpolator size
     :param ft_axes: Axes where FFT takes place
+    :param radix: The radix of the Tensor_sn st['tSN'] of the scaling factors.
+                  If None (default), the dense st['sn'] of 'CSR' and 'OTF'
+                  is returned too, and the radix of 'CSR' is len(Kd) and of 'pELL' is 1.
     :param format: Output format of the interpolator.
                     'CSR': the precomputed Compressed Sparse Row (CSR) matrix.
                     'pELL': partial ELLPACK which precomputes the concatenated 1D interpolators.
+                    'OTF': on-the-fly, which stores only om and the min-max parameters.
+    :param max_memory: The approximate bytes of the temporary arrays of the 'CSR' format.
+                       The CSR is built in chunks of samples within max_memory.
+                       The default is None (64 MiB).
+    :param threads: The number of threads of the planner, which run over the dimensions
+                    and over the sample chunks of the CSR. The default is None (1 thread).
+    :param cache: (Optional) The Plan_cache of the interpolators.
+                  A cached plan of the same om and geometry is returned
+                  without building the interpolator.
+    :param kernel: The 1D interpolator. 'minmax' (default): the exact min-max weights.
+                   'table': the linear interpolation of the min-max weights tabulated
+                   once per (N, J, K), see table_interp() for the accuracy bound.
+    :param dtype: The dtype of the 'CSR' interpolator st['p'], which is filled
+                  directly without a double precision copy.
+                  The default is numpy.complex128.
+    :param adjoint: If True, the 'CSR' format also returns the adjoint
+                    st['pH'] = st['p'].getH().tocsr(), which is cached with st['p'].
+                    The default is False.
+    :param tensor_sn: (Optional) The Tensor_sn st['tSN'] of a previous plan of
+                      the same Nd, Kd, Jd and radix, which is reused instead of
+                      building the scaling factors again (also on a cache hit).
+                      Another geometry raises ValueError. The default is None.
     :type om: numpy.float
     :type Nd: tuple of int
     :type Kd: tuple of int
     :type Jd: tuple of int
     :type ft_axes: tuple of int
-    :type format: string, 'CSR' or 'pELL'
+    :type format: string, 'CSR', 'pELL' or 'OTF'
+    :type max_memory: None or int
+    :type threads: None or int
+    :type cache: None or Plan_cache
+    :type kernel: string, 'minmax' or 'table'
+    :type dtype: numpy.dtype
+    :type adjoint: bool
+    :type tensor_sn: None or Tensor_sn
     :return st: dictionary for NUFFT
 
     """
@@ -683,6 +1778,9 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
     if (len(Nd) != len(Kd)) | (len(Nd) != len(Jd)) | len(Kd) != len(Jd):
         raise KeyError('Nd, Kd, Jd must be in the same length, e.g. Nd=(256,256),Kd=(512,512),Jd=(6,6)')
 
+    if kernel not in ('minmax', 'table'):
+        raise ValueError("kernel must be 'minmax' or 'table'")
+
     dd = numpy.size(Nd)
 
     if ft_axes is None:
@@ -721,6 +1819,25 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
     st['M'] = numpy.int32(M)
     st['om'] = om
 
+    def scale(radix):  # st['tSN'], snd is computed before the call
+        if tensor_sn is None:
+            return Tensor_sn(snd, radix, Kd, Jd)
+        if ((tensor_sn.Nd, tensor_sn.Kd, tensor_sn.Jd, tensor_sn.radix) !=
+                (tuple(Nd), tuple(Kd), tuple(Jd), radix)):
+            raise ValueError('tensor_sn must have the same Nd, Kd, Jd '
+                             'and radix')
+        return tensor_sn
+
+    if cache is not None:
+        key = cache.key(om, Nd, Kd, Jd, ft_axes, format, radix, kernel,
+                        dtype, adjoint)
+        entry = cache.get(key)
+        if entry is not None:
+            st.update(entry)
+            if tensor_sn is not None and 'tSN' in entry:
+                st['tSN'] = scale(entry['tSN'].radix)
+            return st
+
 ###############################################################
 # create scaling factors st['sn'] given alpha/beta
 # higher dimension implementation
@@ -731,20 +1848,61 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
     snd: list
     """
 
-    for dimid in range(0, dd):
+    threads = cpu_threads(threads)
+    if threads > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(threads)
+        pool_map = pool.map
+    else:
+        pool = None
+        pool_map = map
 
+    def fit_dimension(dimid):
         (tmp_alpha, tmp_beta) = nufft_alpha_kb_fit(
             Nd[dimid], Jd[dimid], Kd[dimid])
-        st.setdefault('alpha', []).append(tmp_alpha)
-        st.setdefault('beta', []).append(tmp_beta)
-
-    snd = []
-    for dimid in range(0, dd):
-        snd += [nufft_scale(
-            Nd[dimid],
-            Kd[dimid],
-            st['alpha'][dimid],
-            st['beta'][dimid]), ]
+        tmp_sn = nufft_scale(Nd[dimid], Kd[dimid], tmp_alpha, tmp_beta)
+        return (tmp_alpha, tmp_beta, tmp_sn)
+
+    fits = list(pool_map(fit_dimension, range(0, dd)))
+    st['alpha'] = [fit[0] for fit in fits]
+    st['beta'] = [fit[1] for fit in fits]
+    snd = [fit[2] for fit in fits]
+
+    if format == 'OTF':
+        # matrix-free: the interpolator is computed in k2y and y2k
+        st['otf'] = OnTheFly(om, Nd, Kd, Jd, ft_flag, st['alpha'], st['beta'],
+                             kernel=kernel)
+        if radix is None:
+            st['sn'] = kronecker_scale(snd).real
+        else:  # the separable scaling of the CPU NUFFT
+            st['tSN'] = scale(radix)
+        st['snd'] = snd
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.put(key, st)
+        return st
+    if format == 'CSR':
+        # chunks of the same interpolator, written into the CSR arrays
+        otf = OnTheFly(om, Nd, Kd, Jd, ft_flag, st['alpha'], st['beta'],
+                       kernel=kernel)
+        if max_memory is not None:
+            max_memory = max_memory // threads  # shared by the threads
+        st['p'] = create_csr_chunks(otf, Kd, max_memory=max_memory,
+                                    pool=pool, dtype=dtype)
+        if adjoint:
+            st['pH'] = st['p'].getH().tocsr()
+        if radix is None:
+            st['sn'] = kronecker_scale(snd).real  # only real scaling is relevant
+            st['tSN'] = scale(len(Kd))
+        else:  # the separable scaling of the CPU NUFFT
+            st['tSN'] = scale(radix)
+        st['snd'] = snd
+        st['T'] = otf.T  # reused by NUFFT.update_plan()
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.put(key, st)
+        return st
     """
      higher-order Kronecker product of all dimensions
     """
@@ -753,8 +1911,7 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
     # Iterate over all dimensions and
     # multiply the coefficients of all dimensions
 
-    ud = []
-    for dimid in range(0, dd):  # iterate through all dimensions
+    def interpolator_1d(dimid):
         N = Nd[dimid]
         J = Jd[dimid]
         K = Kd[dimid]
@@ -784,10 +1941,18 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
 
             # phase shift
             #             ud += [QR2(om[:,dimid], N, J, K, snd[dimid], ft_flag[dimid]),]
-            ud += [min_max(N, J, K, alpha, beta, om[:, dimid], ft_flag[dimid]), ]
+            if kernel == 'table':
+                return table_interp(om[:, dimid], N, J, K,
+                                    interpolator_table(N, J, K, alpha, beta))
+            return min_max(N, J, K, alpha, beta, om[:, dimid], ft_flag[dimid])
 
         else:
-            ud += [numpy.ones((1, M), dtype=dtype).T, ]
+            return numpy.ones((1, M), dtype=dtype).T
+
+    # iterate through all dimensions
+    ud = list(pool_map(interpolator_1d, range(0, dd)))
+    if pool is not None:
+        pool.shutdown()
 
     """
     Now compute the column indices for 1D interpolators
@@ -800,23 +1965,16 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
 
         kd += [OMEGA_k(Jd[dimid], Kd[dimid], om[:, dimid], Kd, dimid, dd, ft_flag[dimid]).T, ]
 
-    if format == 'CSR':
-
-        CSR = full_kron(ud, kd, Jd, Kd, M)
-        st['p'] = CSR
-#     st['ell'] = ELL
-        st['sn'] = kronecker_scale(snd).real  # only real scaling is relevant
-        st['tSN'] = Tensor_sn(snd, len(Kd))
-#     ud2, kd2, Jd2 = partial_combination(ud, kd, Jd)
-    elif format == 'pELL':
+    if format == 'pELL':
         if radix is None:
             radix = 1
         ud2, kd2, Jd2 = rdx_kron(ud, kd, Jd, radix=radix)
 #         print(ud2[0].shape, ud2[1].shape, kd2[0].shape, kd2[1].shape, Jd2)
         st['pELL'] = create_partialELL(ud2, kd2, Jd2, M)
+        st['snd'] = snd  # 1D scaling factors
 #         st['tensor_sn'] = snd
 #         st['tensor_sn'] = cat_snd(snd)
-        st['tSN'] = Tensor_sn(snd, radix)
+        st['tSN'] = scale(radix)
 #         numpy.empty((numpy.sum(Nd), ), dtype=numpy.float32)
 #
 #         shift = 0
@@ -827,6 +1985,8 @@ def plan(om, Nd, Kd, Jd, ft_axes=None, format='CSR', radix=None):
     # no dimension-reduction Nd -> Nd
     # Tuple (Nd) -> array (shape = M*sumJd)
 
+    if cache is not None:
+        cache.put(key, st)
     return st  # new
 
 
@@ -1257,6 +2417,7 @@ def nufft_offset(om, J, K):
     return k0
 
 
+@memoize()
 def nufft_alpha_kb_fit(N, J, K):
     """
     Find parameters alpha and beta for scaling factor st['sn']
@@ -1386,6 +2547,7 @@ def nufft_scale1(N, K, alpha, beta, Nmid):
     return sn
 
 
+@memoize()
 def nufft_scale(Nd, Kd, alpha, beta):
     dd = numpy.size(Nd)
     Nmid = (Nd - 1) / 2.0
@@ -1406,6 +2568,7 @@ def mat_inv(A):
     return B
 
 
+@memoize()
 def nufft_T(N, J, K, alpha, beta):
     '''
      Equation (29) and (26) in Fessler and Sutton 2003.
@@ -1432,37 +2595,51 @@ def nufft_T(N, J, K, alpha, beta):
     return mat_inv(cssc)
 
 
-def nufft_r(om, N, J, K, alpha, beta):
+def nufft_r(om, N, J, K, alpha, beta, dk=None):
     '''
     Equation (30) of Fessler & Sutton's paper
 
+    dk (Optional) replaces om by the offsets om/gam - nufft_offset(om)
     '''
-    def iterate_sum(rr, alf, r1):
-        rr = rr + alf * r1
-        return rr
-
     def iterate_l1(L, alpha, arg, beta, K, N, rr):
         oversample_ratio = (1.0 * K / N)
-        import time
-        t0 = time.time()
-        for l1 in range(-L, L + 1):
-            alf = alpha[abs(l1)] * 1.0
-    #         if l1 < 0:
-    #             alf = numpy.conj(alf)
-        #             r1 = numpy.sinc(1.0*(arg+1.0*l1*beta)/(1.0*K/N))
-            input_array = (arg + 1.0 * l1 * beta) / oversample_ratio
-            r1 = dirichlet(input_array)
-            rr = iterate_sum(rr, alf, r1)
+        # All the 2L+1 terms are summed at once, in blocks of samples.
+        # sinc(x) = sin(pi*x)/(pi*x), x = (arg + l1*beta)/oversample_ratio,
+        # and sin(a + l1*d) = sin(a)*cos(l1*d) + cos(a)*sin(l1*d),
+        # so sin() and cos() are evaluated once per (J, M) point.
+        l1 = numpy.arange(-L, L + 1)
+        alf = numpy.ravel(alpha)[numpy.abs(l1)] * 1.0
+        d = numpy.pi * beta / oversample_ratio
+        ld = (l1 * d).reshape((2 * L + 1, 1, 1))
+        alf_cos = alf * numpy.cos(l1 * d)
+        alf_sin = alf * numpy.sin(l1 * d)
+        (J, M) = arg.shape
+        block = max(1, 2 ** 20 // ((2 * L + 1) * J))
+        for m0 in range(0, M, block):
+            a = numpy.pi * arg[:, m0:m0 + block] / oversample_ratio
+            inv_pix = a + ld
+            # The identity loses the relative accuracy near x = 0, so the
+            # nearest term is excluded and computed by sinc() directly.
+            l_near = numpy.clip(numpy.rint(-a / d), -L, L).astype(numpy.int64)
+            (jj, mm) = numpy.nonzero(numpy.abs(a + l_near * d) < 0.1)
+            ll = l_near[jj, mm] + L
+            inv_pix[ll, jj, mm] = numpy.inf
+            numpy.reciprocal(inv_pix, out=inv_pix)
+            r = (numpy.sin(a) * numpy.tensordot(alf_cos, inv_pix, axes=(0, 0)) +
+                 numpy.cos(a) * numpy.tensordot(alf_sin, inv_pix, axes=(0, 0)))
+            r[jj, mm] += alf[ll] * dirichlet((a[jj, mm] + ld[ll, 0, 0]) / numpy.pi)
+            rr[:, m0:m0 + block] = r
         return rr
 
-    M = numpy.size(om)  # 1D size
-    gam = 2.0 * numpy.pi / (K * 1.0)
-    nufft_offset0 = nufft_offset(om, J, K)  # om/gam -  nufft_offset , [M,1]
-    dk = 1.0 * om / gam - nufft_offset0  # om/gam -  nufft_offset , [M,1]
+    if dk is None:
+        gam = 2.0 * numpy.pi / (K * 1.0)
+        nufft_offset0 = nufft_offset(om, J, K)  # om/gam -  nufft_offset , [M,1]
+        dk = 1.0 * om / gam - nufft_offset0  # om/gam -  nufft_offset , [M,1]
+    M = numpy.size(dk)  # 1D size
     arg = outer_sum(-numpy.arange(1, J + 1) * 1.0, dk)
     L = numpy.size(alpha) - 1
 #     print('alpha',alpha)
-    rr = numpy.zeros((J, M), dtype=numpy.float32)
+    rr = numpy.zeros((J, M), dtype=numpy.result_type(alpha, numpy.float64))
     rr = iterate_l1(L, alpha, arg, beta, K, N, rr)
     return (rr, arg)
 
@@ -1522,6 +2699,172 @@ def crop_slice_ind(Nd):
     return [slice(0, Nd[ss]) for ss in range(0, len(Nd))]
 
 
+def sample_order(om, Kd, order='morton', tile=16):
+    """
+    Locality-aware order of the non-uniform samples.
+    Samples are sorted by the grid cell of Kd they fall in, so consecutive
+    rows of the interpolator touch nearby columns.
+
+    :param om: Coordinate, M * ndims, normalized between [-pi, pi]
+    :param Kd: Oversampled grid shape, one element per column of om
+    :param order: 'morton' (Z-order curve of the cells) or 'tile'
+                  (tiles of tile^ndims cells, in row-major order)
+    :param tile: The tile size of the 'tile' order
+    :type om: numpy.float
+    :type Kd: tuple of int
+    :type order: string
+    :type tile: int
+    :return: index: om[index] is the sorted trajectory
+    :rtype: index: numpy.int64 array
+    """
+    Kd = numpy.asarray(Kd, dtype=numpy.int64)
+    cells = numpy.floor(om / (2 * numpy.pi) * Kd).astype(numpy.int64) % Kd
+    dd = cells.shape[1]
+    if order == 'morton':
+        nbits = int(numpy.max(Kd - 1)).bit_length()
+        if nbits * dd > 64:
+            raise ValueError('Kd is too large for the 64-bit Morton code')
+        code = numpy.zeros(cells.shape[0], dtype=numpy.uint64)
+        for b in range(0, nbits):
+            for d in range(0, dd):
+                # the last axis is the fastest varying (C order)
+                bit = ((cells[:, d] >> b) & 1).astype(numpy.uint64)
+                code |= bit << numpy.uint64(b * dd + dd - 1 - d)
+        index = numpy.argsort(code, kind='stable')
+    elif order == 'tile':
+        # lexsort sorts by the last key first
+        keys = [cells[:, d] for d in range(dd - 1, -1, -1)]
+        keys += [cells[:, d] // tile for d in range(dd - 1, -1, -1)]
+        index = numpy.lexsort(keys)
+    else:
+        raise ValueError("order must be 'morton' or 'tile'")
+    return index
+
+
+def cpu_threads(threads=None):
+    """
+    Number of CPU threads for the NUFFT.
+
+    :param threads: None for a single thread,
+                    a negative number for all the CPU cores.
+    :type threads: None or int
+    :return: threads: the number of threads
+    :rtype: threads: int
+    """
+    if threads is None:
+        threads = 1
+    elif threads < 1:
+        threads = os.cpu_count()
+    return int(threads)
+
+
+def fft_backend(backend='numpy', threads=None):
+    """
+    Select the FFT functions of the CPU NUFFT.
+
+    :param backend: 'numpy' (single-threaded),
+                    'scipy' (scipy.fft with workers=threads)
+                    or 'pyfftw' (optional, pyfftw.interfaces with threads)
+    :param threads: the number of threads, see cpu_threads()
+    :type backend: string
+    :type threads: None or int
+    :return: fftn: function fftn(x, axes=None, overwrite_x=False, s=None),
+                   s zero-pads (or crops) the axes before the FFT
+    :return: ifftn: function ifftn(x, axes=None, overwrite_x=False, s=None)
+    """
+    threads = cpu_threads(threads)
+    if backend == 'numpy':
+        # numpy < 2.0 returns complex128 for complex64 input
+        def fftn(x, axes=None, overwrite_x=False, s=None):
+            return numpy.fft.fftn(x, s=s, axes=axes).astype(
+                numpy.result_type(x.dtype, numpy.complex64), copy=False)
+
+        def ifftn(x, axes=None, overwrite_x=False, s=None):
+            return numpy.fft.ifftn(x, s=s, axes=axes).astype(
+                numpy.result_type(x.dtype, numpy.complex64), copy=False)
+
+    elif backend == 'scipy':
+        import scipy.fft
+
+        def fftn(x, axes=None, overwrite_x=False, s=None):
+            return scipy.fft.fftn(x, s=s, axes=axes, overwrite_x=overwrite_x,
+                                  workers=threads)
+
+        def ifftn(x, axes=None, overwrite_x=False, s=None):
+            return scipy.fft.ifftn(x, s=s, axes=axes, overwrite_x=overwrite_x,
+                                   workers=threads)
+
+    elif backend == 'pyfftw':
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.numpy_fft
+        pyfftw.interfaces.cache.enable()  # reuse the FFTW plans
+
+        def fftn(x, axes=None, overwrite_x=False, s=None):
+            return pyfftw.interfaces.numpy_fft.fftn(
+                x, s=s, axes=axes, overwrite_input=overwrite_x,
+                threads=threads)
+
+        def ifftn(x, axes=None, overwrite_x=False, s=None):
+            return pyfftw.interfaces.numpy_fft.ifftn(
+                x, s=s, axes=axes, overwrite_input=overwrite_x,
+                threads=threads)
+
+    else:
+        raise KeyError("fft_backend must be 'numpy', 'scipy' or 'pyfftw'")
+    return fftn, ifftn
+
+
+def rfft_backend(backend='numpy', threads=None):
+    """
+    Select the real FFT functions of the CPU NUFFT, see fft_backend().
+
+    :param backend: 'numpy', 'scipy' or 'pyfftw'
+    :param threads: the number of threads, see cpu_threads()
+    :type backend: string
+    :type threads: None or int
+    :return: rfftn: function rfftn(x, axes=None, s=None),
+                    the half spectrum of the last axis of axes
+    :return: irfftn: function irfftn(x, axes=None, s=None),
+                     s is the shape of the real output over axes
+    """
+    threads = cpu_threads(threads)
+    if backend == 'numpy':
+        # numpy < 2.0 returns double precision for single precision input
+        def rfftn(x, axes=None, s=None):
+            return numpy.fft.rfftn(x, s=s, axes=axes).astype(
+                numpy.result_type(x.dtype, numpy.complex64), copy=False)
+
+        def irfftn(x, axes=None, s=None):
+            return numpy.fft.irfftn(x, s=s, axes=axes).astype(
+                numpy.finfo(x.dtype).dtype, copy=False)
+
+    elif backend == 'scipy':
+        import scipy.fft
+
+        def rfftn(x, axes=None, s=None):
+            return scipy.fft.rfftn(x, s=s, axes=axes, workers=threads)
+
+        def irfftn(x, axes=None, s=None):
+            return scipy.fft.irfftn(x, s=s, axes=axes, workers=threads)
+
+    elif backend == 'pyfftw':
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.numpy_fft
+        pyfftw.interfaces.cache.enable()  # reuse the FFTW plans
+
+        def rfftn(x, axes=None, s=None):
+            return pyfftw.interfaces.numpy_fft.rfftn(
+                x, s=s, axes=axes, threads=threads)
+
+        def irfftn(x, axes=None, s=None):
+            return pyfftw.interfaces.numpy_fft.irfftn(
+                x, s=s, axes=axes, threads=threads)
+
+    else:
+        raise KeyError("fft_backend must be 'numpy', 'scipy' or 'pyfftw'")
+    return rfftn, irfftn
+
+
 def device_list():
     """
     device_list() returns available devices for acceleration as a tuple.
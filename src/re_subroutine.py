@@ -532,12 +532,51 @@ def cHadamard():
 def cSpmvh():
     """
     Return the cSpmvh related kernel source.
-    Only pELL_spmvh_mCoil is provided for Spmvh.
-    NUFFT_hsa_legacy reuses the cCSR_spmv() function, which doubles the storage.
+    pELL_spmvh_mCoil and cCSR_spmvh_vector are provided for Spmvh.
+    NUFFT_hsa_legacy reuses the cCSR_spmv() function, which doubles the storage,
+    unless cCSR_spmvh_vector scatters the rows of the forward CSR.
     """
 
     R = """
 
+        KERNEL void cCSR_spmvh_vector(
+        const     unsigned int   Reps,            // Number of coils
+        const    unsigned int    numRow,        // number of rows of the forward CSR
+        GLOBAL_MEM const unsigned int *rowDelimiters,
+        GLOBAL_MEM const unsigned int *cols,
+        GLOBAL_MEM const float2 *val,
+        GLOBAL_MEM    float2    *k,
+        GLOBAL_MEM const float2 *input)   // y
+        {
+        const unsigned int t = get_local_id(0);
+        const unsigned int vecWidth=${LL};
+        // Thread ID within wavefront
+        const unsigned int id = t & (vecWidth-1);
+        // One row per wavefront
+        unsigned int vecsPerBlock=get_local_size(0)/vecWidth;
+        unsigned int myRow=(get_group_id(0)*vecsPerBlock) + (t/ vecWidth); // the myRow-th non-Cartesian sample
+        unsigned int m = myRow / Reps;
+        unsigned int nc = myRow - m * Reps;
+        float2  u;
+
+        if (myRow < numRow * Reps)
+        {
+        const unsigned int vecStart = rowDelimiters[m];
+        const unsigned int vecEnd = rowDelimiters[m+1];
+        const float2 ydata=input[myRow];
+        for (unsigned int j = vecStart+id;  j<vecEnd; j += vecWidth)
+                        {
+                        const unsigned int col = cols[j];
+                        const float2 spdata=val[j];
+                        // conj(spdata) * ydata
+                        u.x =  spdata.x*ydata.x + spdata.y*ydata.y;
+                        u.y =  - spdata.y*ydata.x + spdata.x*ydata.y;
+                        atomic_add_float2(k + col*Reps + nc, u);
+                        };
+        };  // if (myRow < numRow * Reps)
+        };    // End of cCSR_spmvh_vector
+
+
         KERNEL void pELL_spmvh_mCoil(
         const    unsigned int    Reps,             // number of coils
         const    unsigned int    nRow,        // number of rows
@@ -4,6 +4,14 @@
 #from .example_1D import example_1D
 from .test_init import test_init
 from .test_init_device import test_init_device
+from .test_cpu import (test_batch, test_batch_solve, test_fft_backend,
+                       test_preserve_dtype, test_out, test_toeplitz,
+                       test_gram, test_threads,
+                       test_reorder, test_format, test_store_spH,
+                       test_save_plan, test_plan_cache, test_update_plan,
+                       test_background, test_memo, test_kernel,
+                       test_pruned_fft, test_real, test_hybrid,
+                       test_concurrent, test_csr_chunks, test_planner)
 # from .test_init2 import test_init2
 # from .test_init3 import test_init3
 #from .test_cuda import test_cuda
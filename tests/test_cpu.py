@@ -0,0 +1,631 @@
+from pynufft import NUFFT
+import numpy
+dtype = numpy.complex64
+
+
+def _load_om():
+    import pkg_resources
+
+    DATA_PATH = pkg_resources.resource_filename('pynufft', 'src/data/')
+    # a subset of the 2D trajectory keeps the CPU tests fast
+    om = numpy.load(DATA_PATH+'om2D.npz')['arr_0'][::16]
+    return om
+
+
+def test_batch():
+    Nd = (64, 64)  # image space size
+    Kd = (128, 128)  # k-space size
+    Jd = (6, 6)  # interpolation size
+    batch = 4
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    nfft_batch = NUFFT()
+    nfft_batch.plan(om, Nd, Kd, Jd, batch=batch)
+
+    x = numpy.random.randn(*(Nd + (batch, ))) + 1.0j*numpy.random.randn(*(Nd + (batch, )))
+    y = nfft_batch.forward(x)
+    assert y.shape == (om.shape[0], batch)
+    x2 = nfft_batch.adjoint(y)
+    assert x2.shape == Nd + (batch, )
+
+    for bat in range(0, batch):
+        y1 = nfft.forward(x[..., bat])
+        assert numpy.allclose(y[:, bat], y1, atol=1e-5*numpy.linalg.norm(y1))
+        x1 = nfft.adjoint(y1)
+        assert numpy.allclose(x2[..., bat], x1, atol=1e-5*numpy.linalg.norm(x1))
+
+
+def test_batch_solve():
+    Nd = (32, 32)
+    Kd = (64, 64)
+    Jd = (6, 6)
+    batch = 2
+    om = _load_om()[::16]
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, batch=batch)
+    x = numpy.random.randn(*(Nd + (batch, ))) + 1.0j*numpy.random.randn(*(Nd + (batch, )))
+    y = nfft.forward(x)
+    x2 = nfft.solve(y, 'cg', maxiter=5)
+    assert x2.shape == Nd + (batch, )
+    try:
+        nfft.solve(y, 'L1TVOLS', maxiter=5, rho=0.1)
+        raise AssertionError('L1TVOLS must reject the batch mode')
+    except ValueError:
+        pass
+
+
+def test_fft_backend():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    nfft_scipy = NUFFT()
+    nfft_scipy.plan(om, Nd, Kd, Jd, fft_backend='scipy', threads=2)
+
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+    y2 = nfft_scipy.forward(x)
+    assert numpy.allclose(y, y2, atol=1e-5*numpy.linalg.norm(y))
+    x1 = nfft.adjoint(y)
+    x2 = nfft_scipy.adjoint(y)
+    assert numpy.allclose(x1, x2, atol=1e-5*numpy.linalg.norm(x1))
+
+
+def test_preserve_dtype():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, fft_backend='scipy', preserve_dtype=True)
+    assert nfft.sp.dtype == dtype
+    assert nfft.spH.dtype == dtype
+    assert 'sn' not in nfft.st  # the separable tensor_sn replaces sn
+
+    x = numpy.random.randn(*Nd)  # float64 input
+    xx = nfft.x2xx(x)
+    assert xx.dtype == dtype
+    k = nfft.xx2k(xx)
+    assert k.dtype == dtype
+    y = nfft.k2y(k)
+    assert y.dtype == dtype
+    k2 = nfft.y2k(y.astype(numpy.complex128))
+    assert k2.dtype == dtype
+    xx2 = nfft.k2xx(k2)
+    assert xx2.dtype == dtype
+    x2 = nfft.xx2x(xx2)
+    assert x2.dtype == dtype
+
+    assert nfft.forward(x).dtype == dtype
+    assert nfft.adjoint(y).dtype == dtype
+    assert nfft.selfadjoint(x).dtype == dtype
+
+    nfft_double = NUFFT()
+    nfft_double.plan(om, Nd, Kd, Jd)
+    y_double = nfft_double.forward(x)
+    assert numpy.allclose(y, y_double, atol=1e-5*numpy.linalg.norm(y_double))
+
+
+def test_out():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, fft_backend='scipy', preserve_dtype=True)
+
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+    x2 = nfft.adjoint(y)
+    x3 = nfft.selfadjoint(x)
+
+    y_out = numpy.empty((om.shape[0], ), dtype=dtype)
+    x_out = numpy.empty(Nd, dtype=dtype)
+    assert nfft.forward(x, out=y_out) is y_out
+    assert numpy.allclose(y_out, y, atol=1e-5*numpy.linalg.norm(y))
+    assert nfft.adjoint(y, out=x_out) is x_out
+    assert numpy.allclose(x_out, x2, atol=1e-5*numpy.linalg.norm(x2))
+    assert nfft.selfadjoint(x, out=x_out) is x_out
+    assert numpy.allclose(x_out, x3, atol=1e-5*numpy.linalg.norm(x3))
+
+    # the returned arrays are not the workspaces of the next call
+    y2 = nfft.forward(2*x)
+    assert numpy.allclose(2*y, y2, atol=1e-5*numpy.linalg.norm(y2))
+
+
+def test_toeplitz():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    nfft_toeplitz = NUFFT()
+    nfft_toeplitz.plan(om, Nd, Kd, Jd, toeplitz=True)
+
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    x2 = nfft.selfadjoint(x)
+    x3 = nfft_toeplitz.selfadjoint(x)
+    assert numpy.linalg.norm(x3 - x2) < 1e-4*numpy.linalg.norm(x2)
+
+
+def test_gram():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    nfft_gram = NUFFT()
+    nfft_gram.plan(om, Nd, Kd, Jd, gram=True)
+
+    k = numpy.random.randn(*Kd) + 1.0j*numpy.random.randn(*Kd)
+    k2 = nfft.k2y2k(k)
+    k3 = nfft_gram.k2y2k(k)
+    assert nfft_gram.spHsp is not None
+    assert numpy.allclose(k2, k3, atol=1e-5*numpy.linalg.norm(k2))
+
+
+def test_threads():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    nfft_threads = NUFFT()
+    nfft_threads.plan(om, Nd, Kd, Jd, threads=3)
+
+    k = numpy.random.randn(*Kd) + 1.0j*numpy.random.randn(*Kd)
+    # every row is summed by one thread: identical to the serial SpMV
+    assert numpy.array_equal(nfft.k2y(k), nfft_threads.k2y(k))
+
+    y = nfft.k2y(k)
+    k2 = nfft.y2k(y)
+    for gridding in ('partial', 'tiles'):
+        nfft_threads.plan(om, Nd, Kd, Jd, threads=3, gridding=gridding)
+        assert nfft_threads.gridding == gridding
+        k3 = nfft_threads.y2k(y)
+        assert numpy.allclose(k2, k3, atol=1e-5*numpy.linalg.norm(k2))
+
+
+def test_reorder():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+    x2 = nfft.adjoint(y)
+
+    for reorder in ('morton', 'tile'):
+        nfft_reorder = NUFFT()
+        nfft_reorder.plan(om, Nd, Kd, Jd, reorder=reorder)
+        # y is returned and accepted in the order of om
+        y2 = nfft_reorder.forward(x)
+        assert numpy.allclose(y, y2, atol=1e-5*numpy.linalg.norm(y))
+        x3 = nfft_reorder.adjoint(y)
+        assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+
+
+def test_format():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+    x2 = nfft.adjoint(y)
+
+    for format in ('pELL', 'OTF'):
+        nfft_kron = NUFFT()
+        nfft_kron.plan(om, Nd, Kd, Jd, format=format)
+        assert nfft_kron.sp is None
+        y2 = nfft_kron.forward(x)
+        assert numpy.allclose(y, y2, atol=1e-5*numpy.linalg.norm(y))
+        x3 = nfft_kron.adjoint(y)
+        assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+
+
+def test_store_spH():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    nfft_sp = NUFFT()
+    nfft_sp.plan(om, Nd, Kd, Jd, store_spH=False)
+    assert nfft_sp.spH is None
+
+    y = numpy.random.randn(om.shape[0]) + 1.0j*numpy.random.randn(om.shape[0])
+    x = nfft.adjoint(y)
+    x2 = nfft_sp.adjoint(y)
+    assert numpy.allclose(x, x2, atol=1e-5*numpy.linalg.norm(x))
+
+
+def test_save_plan():
+    import tempfile
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, batch=2, reorder='morton')
+    x = numpy.random.randn(*(Nd + (2, ))) + 1.0j*numpy.random.randn(*(Nd + (2, )))
+    y = nfft.forward(x)
+    x2 = nfft.adjoint(y)
+
+    with tempfile.TemporaryDirectory() as path:
+        nfft.save_plan(path)
+        nfft_loaded = NUFFT()
+        nfft_loaded.load_plan(path)
+        # the interpolator is mapped read-only from the files
+        assert not nfft_loaded.sp.data.flags.writeable
+        assert numpy.array_equal(nfft_loaded.forward(x), y)
+        assert numpy.array_equal(nfft_loaded.adjoint(y), x2)
+        del nfft_loaded
+
+
+def test_plan_cache():
+    import tempfile
+    from pynufft import helper
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+
+    with tempfile.TemporaryDirectory() as path:
+        cache = helper.Plan_cache(path=path)
+        nfft_cached = NUFFT()
+        nfft_cached.plan(om, Nd, Kd, Jd, cache=cache)
+        assert len(cache.entries) == 1
+        sp = nfft_cached.sp
+        spH = nfft_cached.spH
+        # a hit of the memory tier reuses the interpolator and its adjoint
+        nfft_cached.plan(om, Nd, Kd, Jd, cache=cache)
+        assert nfft_cached.sp.data is sp.data
+        assert nfft_cached.spH.data is spH.data
+        assert numpy.array_equal(nfft_cached.forward(x), y)
+
+        # a new cache finds the plan on the disk
+        cache = helper.Plan_cache(path=path)
+        nfft_cached = NUFFT()
+        nfft_cached.plan(om, Nd, Kd, Jd, cache=cache)
+        assert not nfft_cached.sp.data.flags.writeable
+        assert not nfft_cached.spH.data.flags.writeable
+        assert numpy.array_equal(nfft_cached.forward(x), y)
+        assert numpy.array_equal(nfft_cached.adjoint(y), nfft.adjoint(y))
+        del nfft_cached
+
+
+def test_update_plan():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+    M = om.shape[0]
+    add_om = 0.9 * om[:M // 4]
+
+    nfft = NUFFT()
+    nfft.plan(numpy.concatenate((om[M // 4:], add_om)), Nd, Kd, Jd)
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+    x2 = nfft.adjoint(y)
+
+    for reorder in (None, 'morton'):
+        nfft_update = NUFFT()
+        nfft_update.plan(om, Nd, Kd, Jd, reorder=reorder)
+        nfft_update.update_plan(add_om=add_om, remove_rows=range(0, M // 4))
+        assert nfft_update.sp.shape == nfft.sp.shape
+        assert numpy.allclose(nfft_update.forward(x), y,
+                              atol=1e-5*numpy.linalg.norm(y))
+        assert numpy.allclose(nfft_update.adjoint(y), x2,
+                              atol=1e-5*numpy.linalg.norm(x2))
+
+
+def test_background():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+
+    nfft_background = NUFFT()
+    handle = nfft_background.plan(om, Nd, Kd, Jd, background=True)
+    # forward() waits for the plan
+    assert numpy.array_equal(nfft_background.forward(x), y)
+    assert handle.ready()
+    assert handle.wait() == 0
+    assert nfft_background.plan_handle is None
+
+
+def test_memo():
+    from pynufft import helper
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    helper.clear_memo()
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    hits = helper.nufft_T.hits
+    # both dimensions share (N, J, K)
+    assert hits >= 1
+    assert not helper.nufft_alpha_kb_fit(Nd[0], Jd[0], Kd[0])[0].flags.writeable
+
+    nfft_memo = NUFFT()
+    nfft_memo.plan(om, Nd, Kd, Jd)
+    assert helper.nufft_T.hits >= hits + 2
+    # the Tensor_sn of a plan is not memoized, but can be shared explicitly
+    assert nfft_memo.tensor_sn is not nfft.tensor_sn
+    sn = nfft.tensor_sn.multiply(numpy.ones(Nd), dtype=numpy.float64)
+    assert numpy.allclose(sn, helper.kronecker_scale(nfft.st['snd']).real)
+    assert (nfft_memo.sp != nfft.sp).nnz == 0
+
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    nfft_memo.plan(om[::2], Nd, Kd, Jd, tensor_sn=nfft.tensor_sn)
+    assert nfft_memo.tensor_sn is nfft.tensor_sn
+    nfft_new = NUFFT()
+    nfft_new.plan(om[::2], Nd, Kd, Jd)
+    assert numpy.array_equal(nfft_memo.forward(x), nfft_new.forward(x))
+    try:
+        nfft_memo.plan(om, (32, 32), (64, 64), Jd, tensor_sn=nfft.tensor_sn)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('tensor_sn of another Nd must raise ValueError')
+    for (Kd2, Jd2) in (((96, 96), Jd), (Kd, (4, 4))):
+        try:
+            nfft_memo.plan(om, Nd, Kd2, Jd2, tensor_sn=nfft.tensor_sn)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('tensor_sn of another Kd or Jd must raise')
+
+    # a cache hit shares the tensor_sn of the caller too
+    cache = helper.Plan_cache()
+    nfft_memo.plan(om, Nd, Kd, Jd, cache=cache)
+    nfft_memo.plan(om, Nd, Kd, Jd, cache=cache, tensor_sn=nfft.tensor_sn)
+    assert nfft_memo.tensor_sn is nfft.tensor_sn
+
+
+def test_kernel():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd)
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = nfft.forward(x)
+
+    for format in ('CSR', 'pELL', 'OTF'):
+        nfft_table = NUFFT()
+        nfft_table.plan(om, Nd, Kd, Jd, format=format, kernel='table')
+        y2 = nfft_table.forward(x)
+        assert numpy.linalg.norm(y2 - y) < 1e-6*numpy.linalg.norm(y)
+
+
+def test_pruned_fft():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    batch = 2
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, batch=batch, pruned_fft=False)
+    nfft_pruned = NUFFT()
+    nfft_pruned.plan(om, Nd, Kd, Jd, batch=batch)
+    assert nfft_pruned.pruned_fft
+
+    x = numpy.random.randn(*(Nd + (batch, ))) + 1.0j*numpy.random.randn(*(Nd + (batch, )))
+    y = nfft.forward(x)
+    y2 = nfft_pruned.forward(x)
+    assert numpy.allclose(y, y2, atol=1e-5*numpy.linalg.norm(y))
+    x2 = nfft.adjoint(y)
+    x3 = nfft_pruned.adjoint(y)
+    assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+
+
+def test_real():
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    batch = 2
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, batch=batch)
+    nfft_real = NUFFT()
+    nfft_real.plan(om, Nd, Kd, Jd, batch=batch, real=True)
+    assert nfft_real.k_Kd.shape == (128, 65, batch)  # the half spectrum
+
+    x = numpy.random.randn(*(Nd + (batch, )))
+    y = nfft.forward(x)
+    y2 = nfft_real.forward(x)
+    assert numpy.allclose(y, y2, atol=1e-5*numpy.linalg.norm(y))
+    x2 = nfft.adjoint(y).real
+    x3 = nfft_real.adjoint(y)
+    assert x3.dtype == numpy.float32
+    assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+    x2 = nfft.selfadjoint(x).real
+    x3 = nfft_real.selfadjoint(x)
+    assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+
+
+def test_hybrid():
+    Nd = (32, 32, 4)
+    Kd = (64, 64, 4)
+    Jd = (6, 6, 1)
+    om2 = _load_om()[::16]
+    M = om2.shape[0]
+    # the full plan of the stack: every partition repeats the samples of om2
+    om = numpy.zeros((M * Nd[2], 3))
+    om[:, :2] = numpy.repeat(om2, Nd[2], axis=0)
+    om[:, 2] = numpy.tile(numpy.arange(Nd[2]), M)
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, ft_axes=(0, 1))
+    nfft_hybrid = NUFFT()
+    nfft_hybrid.plan(om2, Nd, Kd, Jd, ft_axes=(0, 1), hybrid=True)
+    assert nfft_hybrid.sp.shape == (M, 64 * 64)
+
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = numpy.reshape(nfft.forward(x), (M, Nd[2]))
+    y2 = nfft_hybrid.forward(x)
+    assert y2.shape == (M, Nd[2])
+    assert numpy.allclose(y, y2, atol=1e-5*numpy.linalg.norm(y))
+    x2 = nfft.adjoint(numpy.ravel(y))
+    x3 = nfft_hybrid.adjoint(y)
+    assert x3.shape == Nd
+    assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+
+    # ft_axes which are not the leading axes, compared with the partitions
+    Nd = (4, 32, 32)
+    nfft2d = NUFFT()
+    nfft2d.plan(om2, Nd[1:], Kd[:2], Jd[:2])
+    nfft_hybrid.plan(om2, Nd, (4, ) + Kd[:2], (1, ) + Jd[:2], ft_axes=(1, 2),
+                     hybrid=True)
+    x = numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+    y = numpy.stack([nfft2d.forward(x[p]) for p in range(0, Nd[0])], axis=1)
+    y2 = nfft_hybrid.forward(x)
+    assert numpy.allclose(y, y2, atol=1e-5*numpy.linalg.norm(y))
+    x2 = numpy.stack([nfft2d.adjoint(y[:, p]) for p in range(0, Nd[0])])
+    x3 = nfft_hybrid.adjoint(y)
+    assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+    x2 = numpy.stack([nfft2d.solve(y[:, p], 'dc', maxiter=5)
+                      for p in range(0, Nd[0])])
+    x3 = nfft_hybrid.solve(y, 'dc', maxiter=5)
+    assert x3.shape == Nd
+    assert numpy.allclose(x2, x3, atol=1e-5*numpy.linalg.norm(x2))
+
+
+def test_concurrent():
+    import concurrent.futures
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    nfft = NUFFT()
+    nfft.plan(om, Nd, Kd, Jd, threads=2, reorder='morton')
+    xs = [numpy.random.randn(*Nd) + 1.0j*numpy.random.randn(*Nd)
+          for n in range(0, 8)]
+    ys = [nfft.forward(x) for x in xs]
+    x2s = [nfft.adjoint(y) for y in ys]
+
+    # the threads share the workspaces of the plan
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        ys_pool = list(pool.map(nfft.forward, xs))
+        x2s_pool = list(pool.map(nfft.adjoint, ys))
+    for n in range(0, len(xs)):
+        assert numpy.array_equal(ys[n], ys_pool[n])
+        assert numpy.array_equal(x2s[n], x2s_pool[n])
+
+
+def test_csr_chunks():
+    from pynufft import helper
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()[::4]
+
+    st = helper.plan(om, Nd, Kd, Jd)
+    # 2^18 bytes: about 50 samples per chunk
+    st_chunks = helper.plan(om, Nd, Kd, Jd, max_memory=2 ** 18)
+    assert st_chunks['p'].dtype == numpy.complex128
+    assert numpy.array_equal(st_chunks['p'].indptr, st['p'].indptr)
+    assert numpy.array_equal(st_chunks['p'].indices, st['p'].indices)
+    assert numpy.array_equal(st_chunks['p'].data, st['p'].data)
+
+    # the single precision CSR is filled directly
+    st64 = helper.plan(om, Nd, Kd, Jd, max_memory=2 ** 18,
+                       dtype=numpy.complex64)
+    assert st64['p'].dtype == numpy.complex64
+    assert numpy.array_equal(st64['p'].indices, st['p'].indices)
+    assert numpy.array_equal(st64['p'].data,
+                             st['p'].data.astype(numpy.complex64))
+
+
+def test_planner():
+    from pynufft import helper
+    Nd = (64, 64)
+    Kd = (128, 128)
+    Jd = (6, 6)
+    om = _load_om()
+
+    # the threaded planner runs over the dimensions: identical CSR
+    st = helper.plan(om, Nd, Kd, Jd)
+    st_threads = helper.plan(om, Nd, Kd, Jd, threads=3)
+    assert numpy.array_equal(st_threads['p'].indptr, st['p'].indptr)
+    assert numpy.array_equal(st_threads['p'].indices, st['p'].indices)
+    assert numpy.array_equal(st_threads['p'].data, st['p'].data)
+
+    # the vectorized nufft_r matches the loop over the 2L+1 terms
+    for (N, J, K) in ((64, 6, 128), (100, 7, 150), (32, 4, 64)):
+        (alpha, beta) = helper.nufft_alpha_kb_fit(N, J, K)
+        (rr, arg) = helper.nufft_r(om[:, 0], N, J, K, alpha, beta)
+        L = numpy.size(alpha) - 1
+        rr0 = numpy.zeros_like(rr)
+        for l1 in range(-L, L + 1):
+            alf = numpy.ravel(alpha)[abs(l1)] * 1.0
+            rr0 += alf * helper.dirichlet((arg + 1.0 * l1 * beta) / (1.0 * K / N))
+        assert numpy.allclose(rr, rr0, rtol=1e-12, atol=1e-12)
+
+
+if __name__ == '__main__':
+    test_batch()
+    test_batch_solve()
+    test_fft_backend()
+    test_preserve_dtype()
+    test_out()
+    test_toeplitz()
+    test_gram()
+    test_threads()
+    test_reorder()
+    test_format()
+    test_store_spH()
+    test_save_plan()
+    test_plan_cache()
+    test_update_plan()
+    test_background()
+    test_memo()
+    test_kernel()
+    test_pruned_fft()
+    test_real()
+    test_hybrid()
+    test_concurrent()
+    test_csr_chunks()
+    test_planner()